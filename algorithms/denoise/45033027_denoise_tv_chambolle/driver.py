@@ -18,9 +18,10 @@ from skimage import data, img_as_float, exposure, img_as_ubyte
 from skimage import restoration, data, color, img_as_float, measure
 import sys
 sys.path.append('/PatternFlow/45033027/')
-from torch_denoise_tv_chambolle import denoise_tv_chambolle_torch
+from torch_denoise_tv_chambolle import (denoise_tv_chambolle_torch,
+                                        denoise_tv_chambolle_tiled)
 from skimage._shared.testing import (assert_equal, assert_almost_equal,
-                                     assert_warns, assert_)
+                                     assert_warns, assert_, raises)
 import torchvision.transforms.functional as F  
 from torchvision import transforms
 import numpy as np 
@@ -122,6 +123,81 @@ def test_denoise_tv_chambolle_multichannel():
                                                 multichannel=True)
     assert_equal(denoised[..., 0].numpy(), denoised0.numpy())
 
+def test_denoise_tv_chambolle_batch():
+    # each image of a batch must be denoised as if it was alone
+    rstate = np.random.RandomState(1234)
+    imgs = np.stack([astro_gray + sigma * rstate.standard_normal(astro_gray.shape)
+                     for sigma in (0.05, 0.1, 0.2, 0.4)])
+    imgsT = torch.tensor(imgs)
+    denoised = denoise_tv_chambolle_torch(imgsT, weight=0.1, batch=True)
+    for k in range(len(imgs)):
+        denoised_k = denoise_tv_chambolle_torch(imgsT[k], weight=0.1)
+        assert_almost_equal(denoised[k].numpy(), denoised_k.numpy())
+
+def test_denoise_tv_chambolle_check_every():
+    # the stop criterion tested every 10 iterations stops close to the one
+    # tested at every iteration
+    denoised = denoise_tv_chambolle_torch(astro_grayT, weight=0.1)
+    sparse = denoise_tv_chambolle_torch(astro_grayT, weight=0.1, check_every=10)
+    assert_almost_equal(sparse.numpy(), denoised.numpy(), decimal=2)
+    with raises(ValueError):
+        denoise_tv_chambolle_torch(astro_grayT, weight=0.1, check_every=0)
+
+def test_denoise_tv_chambolle_num_threads():
+    # calls with num_threads from several threads run side by side and the
+    # number of threads is restored after the last of them
+    import threading
+    threads = torch.get_num_threads()
+    results = {}
+    def run(n):
+        results[n] = denoise_tv_chambolle_torch(astro_grayT, weight=0.1,
+                                                num_threads=n)
+    workers = [threading.Thread(target=run, args=(n, )) for n in (1, 2, 3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert_equal(torch.get_num_threads(), threads)
+    denoised = denoise_tv_chambolle_torch(astro_grayT, weight=0.1)
+    for n in (1, 2, 3):
+        assert_almost_equal(results[n].numpy(), denoised.numpy())
+
+def test_denoise_tv_chambolle_compiled():
+    # the TorchScript step gives the eager result, in batch mode too
+    import warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", FutureWarning)
+        compiled = denoise_tv_chambolle_torch(astro_grayT, weight=0.1,
+                                              compiled=True)
+        imgsT = torch.stack([astro_grayT, 2 * astro_grayT])
+        compiled_batch = denoise_tv_chambolle_torch(imgsT, weight=0.1,
+                                                    batch=True, compiled=True)
+    denoised = denoise_tv_chambolle_torch(astro_grayT, weight=0.1)
+    assert_almost_equal(compiled.numpy(), denoised.numpy())
+    denoised_batch = denoise_tv_chambolle_torch(imgsT, weight=0.1, batch=True)
+    assert_almost_equal(compiled_batch.numpy(), denoised_batch.numpy())
+
+def test_denoise_tv_chambolle_coupled_channels():
+    # identical channels: the vectorial TV of C channels is sqrt(C) times
+    # the TV of one channel
+    img = np.stack([astro_gray] * 3, axis=-1)
+    imgT = torch.tensor(img)
+    coupled = denoise_tv_chambolle_torch(imgT, weight=0.1, multichannel=True,
+                                         coupled_channels=True)
+    single = denoise_tv_chambolle_torch(torch.tensor(astro_gray),
+                                        weight=0.1 / np.sqrt(3))
+    for c in range(3):
+        assert_almost_equal(coupled[..., c].numpy(), single.numpy())
+
+def test_denoise_tv_chambolle_tiled():
+    # the halo makes the tiled result close to the whole-volume one
+    x, y, z = np.ogrid[0:60, 0:50, 0:40]
+    mask = ((x - 30)**2 + (y - 20)**2 + (z - 17)**2 < 12**2).astype(np.float64)
+    mask += 0.2 * np.random.RandomState(1234).standard_normal(mask.shape)
+    whole = denoise_tv_chambolle_torch(torch.tensor(mask), weight=0.1)
+    tiled = denoise_tv_chambolle_tiled(mask, tile_shape=24, halo=16, weight=0.1)
+    assert_almost_equal(tiled, whole.numpy(), decimal=2)
+
 if __name__ == '__main__':
     torch.set_printoptions(precision=8)
     astro = img_as_float(data.astronaut()[:128, :128])
@@ -141,6 +217,12 @@ if __name__ == '__main__':
     test_denoise_tv_chambolle_1d()
     test_denoise_tv_chambolle_4d()
     test_denoise_tv_chambolle_weighting()
+    test_denoise_tv_chambolle_batch()
+    test_denoise_tv_chambolle_check_every()
+    test_denoise_tv_chambolle_num_threads()
+    test_denoise_tv_chambolle_compiled()
+    test_denoise_tv_chambolle_coupled_channels()
+    test_denoise_tv_chambolle_tiled()
     
         
     coffee = img_as_float(data.coffee())
@@ -10,42 +10,86 @@ description: this is the denoise function "denoise_tv_chambolle" in skimage.
 It only supports numpy array, this function transfer it and it support torch.tensor.
 """
 
+import contextlib
+import itertools
+import threading
+
+import numpy as np
 import torch
 
+# calls running with num_threads and the number of threads before the first
+# of them, see _num_threads
+_num_threads_lock = threading.Lock()
+_num_threads_users = 0
+_num_threads_previous = None
+
 #%%
 def diff(image, axis):
     '''
-    Take the difference of different dimension(1~4) of images
+    Take the difference of images along any axis
     '''
-    ndim = image.ndim
-    if ndim == 3:    
-        if axis == 0:
-            return image[1:,:,:] - image[:-1,:,:]
-        elif axis == 1:
-            return image[:,1:,:] - image[:,:-1,:]
-        elif axis == 2:
-            return image[:,:,1:] - image[:,:,:-1]
-        
-    elif ndim == 2: 
-        if axis == 0:
-            return image[1:,:] - image[:-1,:]
-        elif axis == 1:
-            return image[:,1:] - image[:,:-1]
-    elif ndim == 4:    
-        if axis == 0:
-            return image[1:,:,:,:] - image[:-1,:,:,:]
-        elif axis == 1:
-            return image[:,1:,:,:] - image[:,:-1,:,:]
-        elif axis == 2:
-            return image[:,:,1:,:] - image[:,:,:-1,:]
-        elif axis == 3:
-            return image[:,:,:,1:] - image[:,:,:,:-1]
-    elif ndim == 1: 
-        if axis == 0:
-            return image[1:] - image[:-1]
+    n = image.shape[axis]
+    return image.narrow(axis, 1, n - 1) - image.narrow(axis, 0, n - 1)
+
+def _chambolle_step(image, pt, gt, dt, current, squares, norm,
+                    weight: float, tau: float, first: int, coupled: bool,
+                    check: bool) -> torch.Tensor:
+    """
+    One iteration of the Chambolle projection, in place: the divergence of
+    the dual variable `pt`, the new estimate `current`, its gradients `gt`
+    and their norm, and the update of `pt`. The spatial axes start at
+    `first`. Returns the energy of each image if `check`, an empty tensor
+    otherwise. The function can be compiled with torch.jit.script.
+    """
+    ndim = pt.shape[0]
+    # dt will be the (negative) divergence of p
+    torch.sum(pt, [0], out=dt)
+    dt.neg_()
+    for ax in range(ndim):
+        n = dt.shape[ax+first]
+        dt.narrow(ax+first, 1, n-1).add_(pt[ax].narrow(ax+first, 0, n-1))
+    torch.add(image, dt, out=current)
+
+    # gt stores the gradients of current along each axis
+    # e.g. gt[0] is the first order finite difference along axis 0
+    squares.zero_()
+    for ax in range(ndim):
+        n = current.shape[ax+first]
+        torch.sub(current.narrow(ax+first, 1, n-1),
+                  current.narrow(ax+first, 0, n-1),
+                  out=gt[ax].narrow(ax+first, 0, n-1))
+        squares.addcmul_(gt[ax], gt[ax])
+    if coupled:
+        torch.sum(squares, [1], keepdim=True, out=norm)
+    norm.sqrt_()
+
+    energy = torch.empty(0, dtype=image.dtype)
+    if check:
+        energy = torch.linalg.vector_norm(dt.flatten(1), dim=1) ** 2
+        energy += weight * norm.flatten(1).sum(1)
+        energy /= float(image[0].numel())
+
+    norm.mul_(tau / weight).add_(1.)
+    pt.sub_(gt, alpha=tau)
+    pt.div_(norm)
+    return energy
+
+
+_compiled_step = None
+
+def _get_step(compiled):
+    """The iteration, compiled with TorchScript on first use if asked."""
+    global _compiled_step
+    if not compiled:
+        return _chambolle_step
+    if _compiled_step is None:
+        _compiled_step = torch.jit.script(_chambolle_step)
+    return _compiled_step
 
                   
-def _denoise_tv_chambolle_nd_torch(image, weight=0.1, eps=2.e-4, n_iter_max=200):
+def _denoise_tv_chambolle_nd_torch(image, weight=0.1, eps=2.e-4, n_iter_max=200,
+                                   batch=False, check_every=1, coupled=False,
+                                   compiled=False):
     """
     image : torch.tensor
         n-D input data to be denoised.
@@ -58,69 +102,93 @@ def _denoise_tv_chambolle_nd_torch(image, weight=0.1, eps=2.e-4, n_iter_max=200)
             (E_(n-1) - E_n) < eps * E_0
     n_iter_max : int, optional
         Maximal number of iterations used for the optimization.
+    batch : bool, optional
+        If True, the first axis of `image` indexes independent images. Each
+        image keeps its own energy, stop criterion and dual variable, and
+        is left out of the iterations once it has converged.
+    check_every : int, optional
+        The energy is only evaluated (and the stop criterion tested) every
+        `check_every` iterations, with the change of energy averaged over
+        these iterations. Each test synchronizes with the device.
+    coupled : bool, optional
+        Only with `batch`: axis 1 of `image` is a channel axis. No gradient
+        is taken along it, and the norm of the gradient is taken across
+        the channels (vectorial total variation).
+    compiled : bool, optional
+        Run the iterations with the TorchScript version of the step.
     Returns
     -------
     out : torch.tensor
         Denoised array of floats.
     
     """    
+    if check_every < 1:
+        raise ValueError("check_every must be at least 1")
+    if not batch:
+        return _denoise_tv_chambolle_nd_torch(image.unsqueeze(0), weight, eps,
+                                              n_iter_max, True, check_every,
+                                              compiled=compiled)[0]
     
-    
-    ndim = image.ndim
-    pt = torch.zeros((image.ndim, ) + image.shape, dtype=image.dtype)
+    # gradients are taken along the axes after the batch (and channel) axes
+    first = 2 if coupled else 1
+    # the images still iterated are compacted at the front of the tensors,
+    # active holds their index in the batch
+    out = torch.empty_like(image)
+    active = torch.arange(image.shape[0])
+    ndim = image.ndim - first
+    tau = 1. / (2.*ndim)
+    step = _get_step(compiled)
+
+    # every buffer is allocated once and updated in place
+    pt = torch.zeros((ndim, ) + image.shape, dtype=image.dtype)
     gt = torch.zeros_like(pt)
     dt = torch.zeros_like(image)
+    current = torch.empty_like(image)
+    if coupled:
+        squares = torch.empty_like(image)
+        norm = torch.empty_like(image[:, :1])
+    else:
+        squares = norm = torch.empty_like(image)
     i = 0
     while i < n_iter_max:
-       if i > 0:
-           # dt will be the (negative) divergence of p
-           dt = -pt.sum(0)
-           slices_dt = [slice(None), ] * ndim
-           slices_pt = [slice(None), ] * (ndim + 1)
-           for ax in range(ndim):
-               slices_dt[ax] = slice(1, None)
-               slices_pt[ax+1] = slice(0, -1)
-               slices_pt[0] = ax
-               dt[tuple(slices_dt)] += pt[tuple(slices_pt)]
-               slices_dt[ax] = slice(None)
-               slices_pt[ax+1] = slice(None)
-           out = image + dt
-       else:
-           out = image
-       Et = torch.mul(dt,dt).sum()
-       
-       # gt stores the gradients of out along each axis
-       # e.g. gt[0] is the first order finite difference along axis 0
-       slices_gt = [slice(None), ] * (ndim + 1)
-       for ax in range(ndim):
-           slices_gt[ax+1] = slice(0, -1)
-           slices_gt[0] = ax
-           gt[tuple(slices_gt)] = diff(out, ax)
-           slices_gt[ax+1] = slice(None)
-            
-       norm = torch.sqrt((gt ** 2).sum(axis=0)).unsqueeze(0)
-       Et = Et + weight * norm.sum()
-       tau = 1. / (2.*ndim)
-       norm = norm * tau / weight
-       norm = norm + 1.
-       pt = pt - tau * gt
-       pt = pt / norm
-       Et = Et / float(image.view(-1).shape[0])
+       check = i % check_every == 0
+       energy = step(image, pt, gt, dt, current, squares, norm, weight, tau,
+                     first, coupled, check)
+       if check:
+           Et = energy
+
        if i == 0:
            E_init = Et
            E_previous = Et
-       else:
-           if torch.abs(E_previous - Et) < eps * E_init:
-               break
-           else:
-               E_previous = Et
+       elif check:
+           converged = torch.abs(E_previous - Et) < eps * E_init * check_every
+           if converged.any():
+               # freeze the converged images, keep iterating the others
+               out[active[converged]] = current[converged]
+               keep = ~converged
+               active = active[keep]
+               if active.numel() == 0:
+                   return out
+               image = image[keep]
+               pt = pt[:, keep]
+               gt = gt[:, keep]
+               dt = dt[keep]
+               current = current[keep]
+               squares = squares[keep]
+               norm = norm[keep] if coupled else squares
+               E_init = E_init[keep]
+               Et = Et[keep]
+           E_previous = Et
        i += 1
-     
+    
+    out[active] = current
     return out
 
 
 def denoise_tv_chambolle_torch(image, weight=0.1, eps=2.e-4, n_iter_max=200,
-                         multichannel=False):
+                         multichannel=False, batch=False, check_every=1,
+                         coupled_channels=False, compiled=False,
+                         num_threads=None):
     
     """Perform total-variation denoising on n-dimensional images.
     Parameters
@@ -141,7 +209,31 @@ def denoise_tv_chambolle_torch(image, weight=0.1, eps=2.e-4, n_iter_max=200,
     multichannel : bool, optional
         Apply total-variation denoising separately for each channel. This
         option should be true for color images, otherwise the denoising is
-        also applied in the channels dimension.
+        also applied in the channels dimension. All the channels are solved
+        at once, each with its own stop criterion.
+    batch : bool, optional
+        Denoise a batch of images at once: the first axis of `image` indexes
+        independent images, each with its own stop criterion. Converged
+        images are frozen while the others continue.
+    check_every : int, optional
+        Evaluate the energy and test the stop criterion only every
+        `check_every` iterations (every iteration by default). The stop
+        criterion then uses the change of energy averaged over these
+        iterations.
+    coupled_channels : bool, optional
+        With `multichannel`, couple the channels through a vectorial total
+        variation: the norm of the gradient is taken across the channels,
+        so that edges are shared by all of them.
+    compiled : bool, optional
+        Run the iterations with a TorchScript compiled step (compiled on
+        the first call), which removes most of the Python overhead of the
+        many small operations of an iteration. Worth it on small images.
+    num_threads : int, optional
+        Number of threads used by torch during the call, restored after
+        the last of the overlapping calls with num_threads. The setting is
+        process-wide and not reentrant: calls running side by side from
+        several threads are not serialized, but all of them use the value
+        set last; use processes to pin denoisers to different numbers.
     Returns
     -------
     out : torch.tensor
@@ -151,14 +243,165 @@ def denoise_tv_chambolle_torch(image, weight=0.1, eps=2.e-4, n_iter_max=200,
     im_type = (image.numpy()).dtype
     if not im_type.kind == 'f':
         image = image.type(torch.float64)
-        image = image/torch.abs(image.max()+image.min())
+        if batch:
+            # each image is scaled on its own, as if denoised separately
+            dims = tuple(range(1, image.ndim))
+            scale = torch.abs(image.amax(dim=dims) + image.amin(dim=dims))
+            image = image/scale.view((-1,) + (1,) * (image.ndim - 1))
+        else:
+            image = image/torch.abs(image.max()+image.min())
         
-    if multichannel:
-        out = torch.zeros_like(image)
-        for c in range(image.shape[-1]):
-            out[...,c] = _denoise_tv_chambolle_nd_torch(image[..., c], weight, eps, n_iter_max)
-    else:
-        out = _denoise_tv_chambolle_nd_torch(image, weight, eps, n_iter_max)
+    with _num_threads(num_threads):
+        if multichannel:
+            # channels last -> (batch, channels, ...), the channel axis being
+            # either folded into the batch axis or kept as a coupled axis
+            images = image if batch else image.unsqueeze(0)
+            images = images.movedim(-1, 1).contiguous()
+            if coupled_channels:
+                out = _denoise_tv_chambolle_nd_torch(images, weight, eps,
+                                                     n_iter_max, True, check_every,
+                                                     coupled=True, compiled=compiled)
+            else:
+                shape = images.shape
+                out = _denoise_tv_chambolle_nd_torch(images.reshape((-1,) + shape[2:]),
+                                                     weight, eps, n_iter_max, True,
+                                                     check_every, compiled=compiled
+                                                     ).reshape(shape)
+            out = out.movedim(1, -1).contiguous()
+            if not batch:
+                out = out[0]
+        else:
+            out = _denoise_tv_chambolle_nd_torch(image, weight, eps, n_iter_max, batch,
+                                                 check_every, compiled=compiled)
     
     return out
 
+
+@contextlib.contextmanager
+def _num_threads(num_threads):
+    """Run with num_threads torch threads. The number of threads before
+    the first of the overlapping calls is restored after the last one; the
+    lock only guards this bookkeeping, the calls themselves run in parallel.
+    None leaves the number of threads alone."""
+    global _num_threads_users, _num_threads_previous
+    if num_threads is None:
+        yield
+        return
+    with _num_threads_lock:
+        if _num_threads_users == 0:
+            _num_threads_previous = torch.get_num_threads()
+        _num_threads_users += 1
+        torch.set_num_threads(num_threads)
+    try:
+        yield
+    finally:
+        with _num_threads_lock:
+            _num_threads_users -= 1
+            if _num_threads_users == 0:
+                torch.set_num_threads(_num_threads_previous)
+
+
+def _blend_weights(lo, hi, size, ramp):
+    """
+    Weights along one axis of the core [lo, hi) of a tile, and the range
+    [start, stop) they cover. Across each inner tile boundary the weight
+    falls linearly over `ramp` pixels while the one of the neighbour rises,
+    so that the weights of all the tiles sum to one.
+    """
+    start = max(lo - (ramp + 1) // 2, 0)
+    stop = min(hi + (ramp + 1) // 2, size)
+    centres = torch.arange(start, stop, dtype=torch.float64) + 0.5
+    weights = torch.ones(stop - start, dtype=torch.float64)
+    if ramp > 0:
+        if lo > 0:
+            weights *= torch.clamp((centres - lo + ramp/2) / ramp, 0., 1.)
+        if hi < size:
+            weights *= torch.clamp((hi + ramp/2 - centres) / ramp, 0., 1.)
+    return start, stop, weights
+
+
+def denoise_tv_chambolle_tiled(image, out=None, tile_shape=64, halo=16,
+                               weight=0.1, eps=2.e-4, n_iter_max=200,
+                               multichannel=False, **kwargs):
+    """Total-variation denoising of volumes larger than memory, by tiles.
+
+    The image is cut into tiles, each extended by a halo of context on
+    every side and denoised on its own. Across the tile boundaries the
+    results are blended with linear weights over `halo` pixels, the rest
+    of the halo being discarded. Only one extended tile is converted to a
+    tensor at a time, so the memory used scales with the tile size.
+    Parameters
+    ----------
+    image : numpy.ndarray
+        n-D input data, typically a memory-mapped array such as
+        np.load(filename, mmap_mode='r').
+    out : numpy.ndarray or str, optional
+        Array receiving the result, or the name of a .npy file created as
+        a memory-mapped array. A new array by default.
+    tile_shape : int or tuple of ints, optional
+        Shape of the tiles, without the halo (same size on every axis if
+        an int). The channel axis is never tiled.
+    halo : int, optional
+        Width of the context added on each side of a tile. It should be
+        large enough for the denoising at the tile centre not to depend
+        on it (a few times the size of the flattened structures).
+    weight, eps, n_iter_max, multichannel : see denoise_tv_chambolle_torch.
+        Each tile has its own stop criterion.
+    kwargs :
+        Other arguments of denoise_tv_chambolle_torch (check_every,
+        coupled_channels, compiled, num_threads).
+    Returns
+    -------
+    out : numpy.ndarray
+        Denoised image, of floats.
+    
+    """
+    spatial = image.ndim - 1 if multichannel else image.ndim
+    if isinstance(tile_shape, int):
+        tile_shape = (tile_shape, ) * spatial
+    if any(halo > tile for tile in tile_shape):
+        raise ValueError("the halo must not be larger than the tiles")
+
+    scale = None
+    dtype = image.dtype
+    if dtype.kind != 'f':
+        # same scaling as denoise_tv_chambolle_torch, over the whole image
+        scale = abs(float(image.max()) + float(image.min()))
+        dtype = np.dtype(np.float64)
+    if out is None:
+        out = np.zeros(image.shape, dtype=dtype)
+    elif isinstance(out, str):
+        out = np.lib.format.open_memmap(out, mode="w+", dtype=dtype,
+                                        shape=image.shape)
+    else:
+        out[...] = 0
+
+    size = image.shape[:spatial]
+    starts = [range(0, n, tile) for n, tile in zip(size, tile_shape)]
+    for corner in itertools.product(*starts):
+        read, write, local, weights = [], [], [], []
+        for lo, n, tile in zip(corner, size, tile_shape):
+            hi = min(lo + tile, n)
+            start, stop, w = _blend_weights(lo, hi, n, halo)
+            first = max(lo - halo, 0)
+            read.append(slice(first, min(hi + halo, n)))
+            write.append(slice(start, stop))
+            local.append(slice(start - first, stop - first))
+            weights.append(w)
+
+        block = torch.from_numpy(np.array(image[tuple(read)], dtype=dtype))
+        if scale is not None:
+            block /= scale
+        denoised = denoise_tv_chambolle_torch(block, weight, eps, n_iter_max,
+                                              multichannel, **kwargs)
+        denoised = denoised[tuple(local)]
+        # separable blending weights, broadcast against the block
+        for axis, w in enumerate(weights):
+            shape = [1] * denoised.ndim
+            shape[axis] = -1
+            denoised = denoised * w.to(denoised.dtype).view(shape)
+        out[tuple(write)] += denoised.numpy()
+
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
@@ -12,11 +12,16 @@ __author__ = "Yi-Tang Wang"
 __email__ = "yitang.wang@uq.net.au"
 __reference__ = ["skimage.restoration.denoise_tv_bregman"]
 
-import torch
+import functools
+import itertools
 import math
 
+import numpy as np
+import torch
+
 
-def denoise_tv_bregman(image, weight, max_iter=100, eps=1e-3):
+def denoise_tv_bregman(image, weight, max_iter=100, eps=1e-3, check_every=1,
+                       isotropic=True, batch=False, solver="gauss-seidel", ndim=2):
     """Perform total-variation denoising using split-Bregman optimization.
 
     Parameters:
@@ -31,88 +36,345 @@ def denoise_tv_bregman(image, weight, max_iter=100, eps=1e-3):
         eps (float):
             Optional
             The threshold of distance between denoised image in iterations
-            The algorithm stops when image distance is smaller than eps
+            The algorithm stops when the root mean square change of the
+            image is smaller than eps
+        check_every (int):
+            Optional
+            The distance is only computed every check_every iterations,
+            each computation synchronizes with the device
+        isotropic (bool):
+            Optional
+            Switch between isotropic (norm of the gradient) and anisotropic
+            (sum of the absolute partial derivatives) total variation
+        batch (bool):
+            Optional
+            The first axis of image indexes independent images, of shape
+            (N, *spatial, dims) or (N, *spatial). They share the
+            buffers of the iteration, and each one stops on its own
+        solver (str):
+            Optional
+            "gauss-seidel" updates the image with one Gauss-Seidel sweep
+            per iteration, in red-black order.
+            "fft" solves its linear system exactly in the Fourier domain,
+            with periodic boundaries, which takes fewer iterations
+        ndim (int):
+            Optional
+            Number of spatial axes, 3 for volumes. The image has the shape
+            (*spatial, dims), or only the spatial shape for a single channel
 
     Returns:
         out (torch.Tensor): denoised image
     """
-    image = atleast_3d(image)
+    if not batch:
+        return denoise_tv_bregman(atleast_nd(image, ndim + 1).unsqueeze(0),
+                                  weight, max_iter, eps, check_every,
+                                  isotropic, batch=True, solver=solver,
+                                  ndim=ndim)[0]
+    if image.dim() == ndim + 1:
+        image = image.unsqueeze(-1)
+    if solver == "fft":
+        return _denoise_tv_bregman_fft(image, weight, max_iter, eps,
+                                       check_every, isotropic)
+    if solver != "gauss-seidel":
+        raise ValueError("unknown solver: {}".format(solver))
 
     img_shape = list(image.shape)
-    rows = img_shape[0]
-    rows2 = rows + 2
-    cols = img_shape[1]
-    cols2 = cols + 2
-    dims = img_shape[2]
-    total = rows * cols * dims
-    shape_extend = (rows2, cols2, dims)
+    total = image[0].numel()
+    shape_extend = [img_shape[0]] + [n + 2 for n in img_shape[1:-1]] + [img_shape[-1]]
     # out is firstly created as zeros-like tensor with size as shape_extend
     out = torch.zeros(shape_extend, dtype=torch.float)
 
-    dx = out.clone().detach()
-    dy = out.clone().detach()
-    bx = out.clone().detach()
-    by = out.clone().detach()
+    # d and b hold one component per spatial axis
+    d = [torch.zeros_like(out) for _ in range(ndim)]
+    b = [torch.zeros_like(out) for _ in range(ndim)]
 
     lam = 2 * weight
-    rmse = float("inf")
-    norm = (weight + 4 * lam)
+    norm = (weight + 2 * ndim * lam)
+
+    out[inner(ndim)] = image
+
+    out = fill_extend(image, out, ndim)
 
-    out_rows, out_cols = out.shape[:2]
-    out[1:out_rows-1, 1:out_cols-1] = image
+    # denoised images, filled as they converge; the images still iterated
+    # are compacted at the front of the buffers, active holds their index
+    result = torch.empty(image.shape, dtype=torch.float)
+    active = torch.arange(img_shape[0])
 
-    out = fill_extend(image, out)
+    # workspace of the iteration, allocated once and updated in place
+    unew = torch.empty(image.shape, dtype=torch.float)
+    uold = torch.empty_like(unew)
+    grad = [torch.empty_like(unew) for _ in range(ndim)]
+    t = [torch.empty_like(unew) for _ in range(ndim)]
+    s = torch.empty_like(unew)
+
+    center = inner(ndim)
+    forward = [shifted(ndim, axis, 1) for axis in range(ndim)]
+    backward = [shifted(ndim, axis, -1) for axis in range(ndim)]
+    colors = checkerboard(img_shape[1:-1])
 
     i = 0
     regularization = torch.mul(image, weight)
     # iterative optimization method
     # split-Bregman iteration
-    while i < max_iter and rmse > eps:
-        uprev = out[1:-1, 1:-1, :]
+    while i < max_iter:
+        # views of the inner (not extended) area
+        u = out[center]
+        dd = [dk[center] for dk in d]
+        bb = [bk[center] for bk in b]
+
+        for axis in range(ndim):
+            torch.sub(out[forward[axis]], u, out=grad[axis])
+
+        checking = (i + 1) % check_every == 0
+        if checking:
+            uold.copy_(u)
+
+        # d and b are fixed during the sweep: the part of the update coming
+        # from them and from the image is computed once, in unew
+        unew.zero_()
+        for axis in range(ndim):
+            unew.add_(d[axis][backward[axis]]).sub_(dd[axis])
+            unew.sub_(b[axis][backward[axis]]).add_(bb[axis])
+        unew.mul_(lam).add_(regularization)
+
+        # Gauss-Seidel sweep in red-black order: the pixels of each color
+        # only have neighbours of the other color, so each half is updated
+        # at once, in place, from the neighbours updated by the previous half
+        for color in colors:
+            for sub, sub_forward, sub_backward, sub_inner in color:
+                usub = out[sub]
+                torch.add(out[sub_forward[0]], out[sub_backward[0]], out=usub)
+                for axis in range(1, ndim):
+                    usub.add_(out[sub_forward[axis]]).add_(out[sub_backward[axis]])
+                usub.mul_(lam).add_(unew[sub_inner]).div_(norm)
+
+        converged = None
+        if checking:
+            rmse = torch.linalg.vector_norm((u - uold).flatten(1), dim=1)
+            converged = rmse / math.sqrt(total) <= eps
+
+        for axis in range(ndim):
+            torch.add(grad[axis], bb[axis], out=t[axis])
+        shrink(t, lam, isotropic, dd, s, unew)
+
+        for axis in range(ndim):
+            bb[axis].add_(grad[axis]).sub_(dd[axis])
 
-        ux = out[1:-1, 2:, :] - uprev
-        uy = out[2:, 1:-1, :] - uprev
+        i += 1
+        if converged is not None and converged.any():
+            # store the converged images, keep iterating the others
+            result[active[converged]] = u[converged]
+            keep = ~converged
+            active = active[keep]
+            if active.numel() == 0:
+                return result
+            out = out[keep]
+            d = [dk[keep] for dk in d]
+            b = [bk[keep] for bk in b]
+            regularization = regularization[keep]
+            unew, uold, s = unew[keep], uold[keep], s[keep]
+            grad = [g[keep] for g in grad]
+            t = [tk[keep] for tk in t]
+    # return the denoised images excluding the extended area
+    result[active] = out[center]
+    return result
+
+
+def _denoise_tv_bregman_fft(image, weight, max_iter, eps, check_every,
+                            isotropic):
+    """split-Bregman iteration on (N, *spatial, dims) images, solving the
+    image update exactly with FFTs
+
+    the update solves (weight - lam * laplacian) u = weight * image
+    - lam * div(d - b), whose matrix is diagonal in the Fourier domain with
+    periodic boundaries, so all the differences are periodic too
+    """
+    n_images = image.shape[0]
+    spatial = tuple(image.shape[1:-1])
+    ndim = len(spatial)
+    axes = tuple(range(1, ndim + 1))
+    total = image[0].numel()
+    lam = 2 * weight
+    denominator = _fft_denominator(spatial, weight, lam)
+
+    image = image.to(torch.float)
+    u = image.clone()
+    d = [torch.zeros_like(u) for _ in range(ndim)]
+    b = [torch.zeros_like(u) for _ in range(ndim)]
+    grad = [torch.empty_like(u) for _ in range(ndim)]
+    t = [torch.empty_like(u) for _ in range(ndim)]
+    s = torch.empty_like(u)
+    rhs = torch.empty_like(u)
+
+    result = torch.empty_like(u)
+    active = torch.arange(n_images)
+    regularization = torch.mul(image, weight)
 
-        unew = torch.div(
-            (torch.mul((out[2:, 1:-1, :]
-                    + out[0:-2, 1:-1, :]
-                    + out[1:-1, 2:, :]
-                    + out[1:-1, 0:-2, :]
+    i = 0
+    while i < max_iter:
+        # t holds d - b, rhs the right-hand side of the system
+        rhs.zero_()
+        for axis in range(ndim):
+            torch.sub(d[axis], b[axis], out=t[axis])
+            rhs.add_(torch.roll(t[axis], 1, axis + 1)).sub_(t[axis])
+        rhs.mul_(lam).add_(regularization)
+        unew = torch.fft.irfftn(torch.fft.rfftn(rhs, dim=axes) / denominator,
+                                s=spatial, dim=axes)
+
+        converged = None
+        if (i + 1) % check_every == 0:
+            rmse = torch.linalg.vector_norm((unew - u).flatten(1), dim=1)
+            converged = rmse / math.sqrt(total) <= eps
+        u.copy_(unew)
+
+        for axis in range(ndim):
+            torch.sub(torch.roll(u, -1, axis + 1), u, out=grad[axis])
+            torch.add(grad[axis], b[axis], out=t[axis])
+        shrink(t, lam, isotropic, d, s, rhs)
+
+        for axis in range(ndim):
+            b[axis].add_(grad[axis]).sub_(d[axis])
+
+        i += 1
+        if converged is not None and converged.any():
+            # store the converged images, keep iterating the others
+            result[active[converged]] = u[converged]
+            keep = ~converged
+            active = active[keep]
+            if active.numel() == 0:
+                return result
+            u, s, rhs = u[keep], s[keep], rhs[keep]
+            regularization = regularization[keep]
+            d = [dk[keep] for dk in d]
+            b = [bk[keep] for bk in b]
+            grad = [g[keep] for g in grad]
+            t = [tk[keep] for tk in t]
+    result[active] = u
+    return result
+
+
+@functools.lru_cache(maxsize=16)
+def _fft_denominator(spatial, weight, lam):
+    """eigenvalues of weight - lam * (periodic laplacian) on the rfftn grid,
+    shaped to broadcast against (N, *spatial[:-1], spatial[-1] // 2 + 1,
+    dims) spectra"""
+    ndim = len(spatial)
+    laplacian = torch.zeros(spatial[:-1] + (spatial[-1] // 2 + 1, ),
+                            dtype=torch.float64)
+    for axis, n in enumerate(spatial):
+        k = torch.arange(laplacian.shape[axis])
+        shape = [1] * ndim
+        shape[axis] = -1
+        laplacian += (2 - 2 * torch.cos(2 * math.pi * k / n)).view(shape)
+    return (weight + lam * laplacian).to(torch.float)[..., None]
+
+
+def shrink(t, lam, isotropic, d, s, tmp):
+    """shrinkage of the components t of the gradient into d
+
+    t and d are lists with a tensor per spatial axis, s and tmp are work
+    buffers of the same shape
+    """
+    if isotropic:
+        # shrinkage factor lam*s / (lam*s + 1)
+        torch.mul(t[0], t[0], out=s)
+        for tk in t[1:]:
+            s.addcmul_(tk, tk)
+        s.sqrt_().mul_(lam)
+        torch.add(s, 1, out=tmp)
+        s.div_(tmp)
+        for tk, dk in zip(t, d):
+            torch.mul(tk, s, out=dk)
+    else:
+        # soft thresholding of each derivative at 1/lam
+        for tk, dk in zip(t, d):
+            torch.clamp(tk, -1 / lam, 1 / lam, out=s)
+            torch.sub(tk, s, out=dk)
 
-                    + dx[1:-1, 0:-2, :]
-                    - dx[1:-1, 1:-1, :]
-                    + dy[0:-2, 1:-1, :]
-                    - dy[1:-1, 1:-1, :]
 
-                    - bx[1:-1, 0:-2, :]
-                    + bx[1:-1, 1:-1, :]
-                    - by[0:-2, 1:-1, :]
-                    + by[1:-1, 1:-1, :]), lam) + regularization),
-             norm)
-        out[1:-1, 1:-1, :] = unew.clone().detach()
+def denoise_tv_bregman_slabs(volume, weight, slab=32, halo=16, out=None,
+                             **kwargs):
+    """3-D total-variation denoising of a volume too large for memory,
+    slab by slab along its first axis
 
-        rmse = torch.norm(unew-uprev, p=2)
+    each slab is denoised with halo planes of context on both sides, which
+    are then discarded; only one slab is held as a tensor at a time
 
-        bxx = bx[1:-1, 1:-1, :].clone().detach()
-        byy = by[1:-1, 1:-1, :].clone().detach()
+    Parameters:
+        volume (numpy.ndarray):
+            Volume of shape (planes, rows, cols) or (planes, rows, cols,
+            dims), typically memory-mapped with np.load(mmap_mode='r')
+        weight (float):
+            Denoising weight, see denoise_tv_bregman
+        slab (int):
+            Optional
+            Number of planes denoised at a time, without the halos
+        halo (int):
+            Optional
+            Number of planes of context added on each side of a slab
+        out (numpy.ndarray or str):
+            Optional
+            Array receiving the result, or the name of a .npy file created
+            as a memory-mapped array. A new array by default
+        kwargs:
+            Other arguments of denoise_tv_bregman (max_iter, eps,
+            check_every, isotropic, solver)
 
-        tx = ux + bxx
-        ty = uy + byy
-        s = torch.sqrt(torch.pow(tx, 2)+torch.pow(ty, 2))
-        dxx = torch.div(torch.addcmul(torch.zeros(s.shape, dtype=torch.float), lam, s, tx),
-                        torch.add(torch.mul(s, lam), 1))
-        dyy = torch.div(torch.addcmul(torch.zeros(s.shape, dtype=torch.float), lam, s, ty),
-                        torch.add(torch.mul(s, lam), 1))
+    Returns:
+        out (numpy.ndarray): denoised volume, of float32
+    """
+    shape = volume.shape if volume.ndim == 4 else volume.shape + (1, )
+    if out is None:
+        out = np.empty(shape, dtype=np.float32)
+    elif isinstance(out, str):
+        out = np.lib.format.open_memmap(out, mode="w+", dtype=np.float32,
+                                        shape=shape)
+    planes = shape[0]
+    for start in range(0, planes, slab):
+        stop = min(start + slab, planes)
+        first = max(start - halo, 0)
+        last = min(stop + halo, planes)
+        block = torch.from_numpy(np.asarray(volume[first:last], dtype=np.float32))
+        denoised = denoise_tv_bregman(block, weight, ndim=3, **kwargs)
+        out[start:stop] = denoised[start - first:stop - first].numpy()
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
 
-        dx[1:-1, 1:-1, :] = dxx.clone().detach()
-        dy[1:-1, 1:-1, :] = dyy.clone().detach()
 
-        bx[1:-1, 1:-1, :] += ux - dxx
-        by[1:-1, 1:-1, :] += uy - dyy
+def checkerboard(spatial):
+    """strided sub-grids of the red and black pixels of a spatial shape,
+    the ones whose sum of indices is even and odd
 
-        i += 1
-    # return the denoised image excluding the extended area
-    return out[1:-1, 1:-1]
+    each color is a list of the sub-grids of its pixels with a given parity
+    along every axis, as (center, forward, backward, inner) indices: the
+    sub-grid in an extended (N, *spatial, dims) tensor, its neighbours
+    after and before it along each axis there, and the sub-grid in a
+    tensor of the (N, *spatial, dims) shape
+    """
+    ndim = len(spatial)
+    colors = ([], [])
+    for parity in itertools.product((0, 1), repeat=ndim):
+        if any(p >= n for p, n in zip(parity, spatial)):
+            continue
+        center = [slice(1 + p, 1 + n, 2) for p, n in zip(parity, spatial)]
+        forward, backward = [], []
+        for axis, (p, n) in enumerate(zip(parity, spatial)):
+            after, before = list(center), list(center)
+            after[axis] = slice(2 + p, 2 + n, 2)
+            before[axis] = slice(p, n, 2)
+            forward.append(_batch_index(after))
+            backward.append(_batch_index(before))
+        sub_inner = [slice(p, n, 2) for p, n in zip(parity, spatial)]
+        colors[sum(parity) % 2].append((_batch_index(center), forward,
+                                        backward, _batch_index(sub_inner)))
+    return colors
+
+
+def _batch_index(spatial_index):
+    """index of (N, *spatial, dims) tensors from an index of the spatial
+    axes"""
+    return (slice(None), ) + tuple(spatial_index) + (slice(None), )
 
 
 def atleast_3d(image):
@@ -129,21 +391,48 @@ def atleast_3d(image):
         image (torch.Tensor):
             image that has at least 3 dimensions
     """
+    return atleast_nd(image, 3)
+
+
+def atleast_nd(image, n):
+    """to ensure the image has at least n dimensions, by adding a last
+    (channel) axis of size 1 to an image of n - 1 dimensions"""
     dim = list(image.shape)
 
-    if len(dim) >= 3:
+    if len(dim) >= n:
         return image
     else:
         dim.append(1)
         return image.view(dim)
 
 
-def fill_extend(image, out):
-    """fill the extended area in out img with original img"""
-    out_rows, out_cols = out.shape[:2]
-    rows, cols = out_rows - 2, out_cols - 2
-    out[0, 1:out_cols-1] = image[1, :]
-    out[1:out_rows-1, 0] = image[:, 1]
-    out[out_rows-1, 1:out_cols-1] = image[rows-1, :]
-    out[1:out_rows-1, out_cols-1] = image[:, cols-1]
+def inner(ndim):
+    """index of the inner (not extended) area of the ndim spatial axes of
+    an extended (N, *spatial, dims) tensor"""
+    return (slice(None), ) + (slice(1, -1), ) * ndim + (slice(None), )
+
+
+def shifted(ndim, axis, step):
+    """index of the inner area shifted by step along a spatial axis"""
+    index = list(inner(ndim))
+    index[axis + 1] = slice(1 + step, -1 + step if step < 1 else None)
+    return tuple(index)
+
+
+def fill_extend(image, out, ndim=2):
+    """fill the extended area in out img with original img
+
+    the ndim spatial axes are the last ones before the channel axis, any
+    axes before them index a batch of images
+    """
+    for axis in range(-ndim - 1, -1):
+        n = out.shape[axis] - 2
+        # the face is the inner area of the other spatial axes
+        face = [slice(None)] * out.dim()
+        for other in range(-ndim - 1, -1):
+            face[other] = slice(1, out.shape[other] - 1)
+        low, high = list(face), list(face)
+        low[axis], high[axis] = 0, n + 1
+        out[tuple(low)] = image.select(axis, 1)
+        out[tuple(high)] = image.select(axis, n - 1)
     return out
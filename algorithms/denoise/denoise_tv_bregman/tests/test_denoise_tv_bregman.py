@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+from os.path import abspath, dirname
+from sys import path
+import numpy as np
+import pytest
+import torch
+from skimage import data, restoration
+
+path.append(dirname(dirname(abspath(__file__))))
+
+import denoise_tv_bregman
+
+def noisy_camera(shape=(128, 128), sigma=0.1):
+    image = data.camera()[100:100 + shape[0], 100:100 + shape[1]] / 255.
+    noise = np.random.RandomState(0).standard_normal(image.shape)
+    return (image + sigma * noise).astype(np.float32)
+
+@pytest.mark.parametrize('weight', [0.5, 1, 2, 5, 10])
+def test_weights(weight):
+    noisy = noisy_camera()
+    denoised = denoise_tv_bregman.denoise_tv_bregman(
+        torch.from_numpy(noisy), weight)[..., 0].numpy()
+    expected = restoration.denoise_tv_bregman(noisy, weight)
+    assert np.isfinite(denoised).all()
+    assert np.abs(denoised - expected).mean() < 5e-3
+    np.testing.assert_allclose(denoised, expected, atol=0.1)
+
+@pytest.mark.parametrize('weight', [0.5, 10])
+def test_converged(weight):
+    # run to convergence, both sweeps reach the same minimizer
+    noisy = noisy_camera((64, 64))
+    denoised = denoise_tv_bregman.denoise_tv_bregman(
+        torch.from_numpy(noisy), weight, max_iter=2000, eps=1e-6)[..., 0]
+    expected = restoration.denoise_tv_bregman(noisy, weight, max_num_iter=2000,
+                                              eps=1e-6)
+    np.testing.assert_allclose(denoised.numpy(), expected, atol=2e-3)
+
+@pytest.mark.parametrize('weight', [0.5, 2, 10])
+def test_anisotropic(weight):
+    noisy = noisy_camera((64, 64))
+    denoised = denoise_tv_bregman.denoise_tv_bregman(
+        torch.from_numpy(noisy), weight, max_iter=2000, eps=1e-6,
+        isotropic=False)[..., 0]
+    expected = restoration.denoise_tv_bregman(noisy, weight, max_num_iter=2000,
+                                              eps=1e-6, isotropic=False)
+    np.testing.assert_allclose(denoised.numpy(), expected, atol=2e-3)
+
+@pytest.mark.parametrize('isotropic', [True, False])
+def test_batch(isotropic):
+    # images converging after different numbers of iterations
+    noisy = noisy_camera((64, 64))
+    images = torch.from_numpy(np.stack([noisy, 0.5 * noisy, noisy[::-1]]))
+    denoised = denoise_tv_bregman.denoise_tv_bregman(
+        images, 2, isotropic=isotropic, batch=True)
+    assert denoised.shape == (3, 64, 64, 1)
+    for image, result in zip(images, denoised):
+        expected = denoise_tv_bregman.denoise_tv_bregman(
+            image, 2, isotropic=isotropic)
+        np.testing.assert_allclose(result.numpy(), expected.numpy(),
+                                   atol=1e-6)
+
+@pytest.mark.parametrize('shape', [(64, 64), (63, 50), (45, 45), (64, 37)])
+def test_fft_denominator(shape):
+    # the rfftn solve inverts weight - lam * (periodic laplacian), also
+    # for odd last axes
+    weight, lam = 2., 4.
+    x = torch.from_numpy(np.random.RandomState(0).rand(1, *shape, 1)).float()
+    system = weight * x
+    for axis in (1, 2):
+        system -= lam * (torch.roll(x, 1, axis) + torch.roll(x, -1, axis) - 2 * x)
+    denominator = denoise_tv_bregman._fft_denominator(shape, weight, lam)
+    solved = torch.fft.irfftn(torch.fft.rfftn(system, dim=(1, 2)) / denominator,
+                              s=shape, dim=(1, 2))
+    np.testing.assert_allclose(solved.numpy(), x.numpy(), atol=1e-4)
+
+@pytest.mark.parametrize('shape', [(64, 64), (63, 50), (45, 45), (64, 37)])
+@pytest.mark.parametrize('weight', [0.5, 2, 10])
+def test_fft(shape, weight):
+    # periodic boundaries: the results only agree away from the borders
+    noisy = noisy_camera(shape)
+    denoised = denoise_tv_bregman.denoise_tv_bregman(
+        torch.from_numpy(noisy), weight, solver='fft')[..., 0].numpy()
+    gauss_seidel = denoise_tv_bregman.denoise_tv_bregman(
+        torch.from_numpy(noisy), weight)[..., 0].numpy()
+    expected = restoration.denoise_tv_bregman(noisy, weight)
+    assert denoised.shape == shape
+    center = (slice(8, -8), ) * 2
+    np.testing.assert_allclose(denoised[center], expected[center], atol=0.05)
+    np.testing.assert_allclose(denoised[center], gauss_seidel[center],
+                               atol=0.05)
+    assert np.abs(denoised - expected).mean() < 0.05
+def reference_tv_bregman(image, weight, max_iter=100, eps=1e-3,
+                         isotropic=True):
+    """the Gauss-Seidel split-Bregman loop of scikit-image, in lexicographic
+    order, on a single channel image of any dimension (scikit-image only
+    has the 2-D one)"""
+    ndim = image.ndim
+    out = np.zeros([n + 2 for n in image.shape])
+    center = (slice(1, -1), ) * ndim
+    out[center] = image
+    for axis in range(ndim):
+        low, high = list(center), list(center)
+        low[axis], high[axis] = 0, -1
+        out[tuple(low)] = image.take(1, axis)
+        out[tuple(high)] = image.take(-1, axis)
+    strides = [s // out.itemsize for s in out.strides]
+    flat = np.ravel_multi_index(np.indices(image.shape).reshape(ndim, -1) + 1,
+                                out.shape)
+    u = out.ravel().tolist()
+    d = [[0.] * out.size for _ in range(ndim)]
+    b = [[0.] * out.size for _ in range(ndim)]
+    lam = 2 * weight
+    norm = weight + 2 * ndim * lam
+    for _ in range(max_iter):
+        rmse = 0
+        for q, f in zip(flat.tolist(), image.ravel().tolist()):
+            uprev = u[q]
+            grad = [u[q + k] - uprev for k in strides]
+            unew = 0
+            for a, k in enumerate(strides):
+                unew += u[q + k] + u[q - k] + d[a][q - k] - d[a][q]
+                unew += b[a][q] - b[a][q - k]
+            unew = (lam * unew + weight * f) / norm
+            u[q] = unew
+            rmse += (unew - uprev) ** 2
+            t = [g + b[a][q] for a, g in enumerate(grad)]
+            if isotropic:
+                s = lam * np.sqrt(sum(tk * tk for tk in t))
+                dnew = [tk * s / (s + 1) for tk in t]
+            else:
+                dnew = [tk - np.clip(tk, -1 / lam, 1 / lam) for tk in t]
+            for a in range(ndim):
+                d[a][q] = dnew[a]
+                b[a][q] += grad[a] - dnew[a]
+        if np.sqrt(rmse / image.size) < eps:
+            break
+    return np.array(u).reshape(out.shape)[center]
+
+def test_reference():
+    noisy = noisy_camera((32, 48)).astype(np.float64)
+    expected = restoration.denoise_tv_bregman(noisy, 2)
+    np.testing.assert_allclose(reference_tv_bregman(noisy, 2), expected,
+                               atol=1e-6)
+
+def noisy_volume(shape=(8, 12, 16), sigma=0.2):
+    volume = np.zeros(shape)
+    volume[2:-2, 3:-3, 4:-4] = 1
+    noise = np.random.RandomState(0).standard_normal(shape)
+    return (volume + sigma * noise).astype(np.float32)
+
+@pytest.mark.parametrize('weight', [0.5, 2, 10])
+def test_volume(weight):
+    noisy = noisy_volume()
+    denoised = denoise_tv_bregman.denoise_tv_bregman(
+        torch.from_numpy(noisy), weight, max_iter=2000, eps=1e-5,
+        ndim=3)[..., 0].numpy()
+    expected = reference_tv_bregman(noisy.astype(np.float64), weight,
+                                    max_iter=2000, eps=1e-5)
+    np.testing.assert_allclose(denoised, expected, atol=3e-3)
+
+def test_slabs():
+    noisy = noisy_volume((40, 24, 24))
+    whole = denoise_tv_bregman.denoise_tv_bregman(
+        torch.from_numpy(noisy), 2, ndim=3).numpy()
+    # halos reaching the ends of the volume: the same result
+    slabs = denoise_tv_bregman.denoise_tv_bregman_slabs(noisy, 2, slab=8,
+                                                        halo=40)
+    np.testing.assert_array_equal(slabs, whole)
+    slabs = denoise_tv_bregman.denoise_tv_bregman_slabs(noisy, 2, slab=8,
+                                                        halo=8)
+    assert np.abs(slabs - whole).mean() < 1e-3
+    np.testing.assert_allclose(slabs, whole, atol=0.02)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+from os.path import abspath, dirname
+from sys import path
+import numpy as np
+import pytest
+import tensorflow as tf
+from scipy.signal import convolve2d
+from skimage import color, data, restoration
+
+path.append(dirname(dirname(abspath(__file__))))
+
+import unspvd_wiener
+
+PSF = np.ones((5, 5)) / 25
+
+def astronaut(sigma=0.05, seed=0):
+    image = color.rgb2gray(data.astronaut())[100:356, 100:356]
+    blurred = convolve2d(image, PSF, 'same')
+    noise = np.random.RandomState(seed).standard_normal(image.shape)
+    return image, blurred + sigma * noise
+
+def error(deconvolved, image):
+    # away from the borders, where the circular convolution differs
+    inner = (slice(10, -10), ) * 2
+    return np.sqrt(np.mean((deconvolved[inner] - image[inner]) ** 2))
+
+def test_skimage():
+    tf.random.set_seed(0)
+    image, noisy = astronaut()
+    deconvolved, chains = unspvd_wiener.unsupervised_wiener(noisy, PSF)
+    expected, expected_chains = restoration.unsupervised_wiener(noisy, PSF,
+                                                                rng=0)
+    assert deconvolved.shape == image.shape
+    assert error(deconvolved, image) < 1.05 * error(expected, image)
+    # the precisions after the burn-in stay in the range of scikit-image
+    for key in ('noise', 'prior'):
+        chain = chains[key][15:]
+        expected_chain = np.array(expected_chains[key][15:])
+        assert chain.min() > 0.9 * expected_chain.min()
+        assert chain.max() < 1.1 * expected_chain.max()
+    assert abs(len(chains['noise']) - len(expected_chains['noise'])) <= 10
+
+def test_iterations():
+    # scikit-image names the keys min_num_iter and max_num_iter
+    tf.random.set_seed(0)
+    _, noisy = astronaut()
+    _, chains = unspvd_wiener.unsupervised_wiener(
+        noisy, PSF, user_params={'min_iter': 50, 'max_iter': 50})
+    _, expected_chains = restoration.unsupervised_wiener(
+        noisy, PSF, user_params={'min_num_iter': 50, 'max_num_iter': 50},
+        rng=0)
+    assert chains['noise'].shape == chains['prior'].shape == (51, )
+    assert len(expected_chains['noise']) == 51
+    np.testing.assert_allclose(chains['noise'][-10:].mean(),
+                               np.mean(expected_chains['noise'][-10:]),
+                               rtol=0.05)
+
+def test_no_retracing():
+    # new hyperparameters and image shapes run the same graph
+    tf.random.set_seed(0)
+    _, noisy = astronaut()
+    sampler = unspvd_wiener._gibbs_sampler(True, 1, False)
+    for params, image in (({'threshold': 1e-3, 'burnin': 5}, noisy),
+                          ({'min_iter': 10, 'max_iter': 20, 'thin': 2}, noisy),
+                          ({'rhat': 1.1}, noisy[:128, :100])):
+        unspvd_wiener.unsupervised_wiener(image, PSF, user_params=params)
+    assert sampler.experimental_get_tracing_count() == 1
+
+def test_chains():
+    tf.random.set_seed(0)
+    image, noisy = astronaut()
+    deconvolved, chains = unspvd_wiener.unsupervised_wiener(
+        noisy, PSF, user_params={'chains': 3})
+    n = len(chains['noise'])
+    assert 31 < n <= 201
+    assert chains['noise'].shape == chains['prior'].shape == (n, 3)
+    assert not np.isnan(chains['noise']).any()
+    # the chains start spread and have mixed when the sampler stops
+    np.testing.assert_allclose(chains['noise'][0], [0.1, 1, 10], rtol=1e-6)
+    assert isinstance(chains['rhat'], float)
+    assert n == 201 or chains['rhat'] < 1.05
+    assert 'iterations' not in chains
+    assert error(deconvolved, image) < 0.07
+
+def test_stack():
+    tf.random.set_seed(0)
+    image, noisy = astronaut()
+    # a noisier image, which stops after another number of iterations
+    _, noisier = astronaut(sigma=0.1, seed=1)
+    deconvolved, chains = unspvd_wiener.unsupervised_wiener(
+        np.stack([noisy, noisier]), PSF)
+    n = len(chains['noise'])
+    assert deconvolved.shape == (2, ) + image.shape
+    assert chains['noise'].shape == chains['prior'].shape == (n, 2)
+    assert chains['iterations'].shape == (2, )
+    assert n == chains['iterations'].max() + 1
+    assert 'rhat' not in chains
+    for index, single in enumerate([noisy, noisier]):
+        expected, expected_chains = unspvd_wiener.unsupervised_wiener(
+            single, PSF)
+        stop = chains['iterations'][index] + 1
+        # the chain of an image stops with it, and continues with NaN
+        assert not np.isnan(chains['noise'][:stop, index]).any()
+        assert np.isnan(chains['noise'][stop:, index]).all()
+        assert abs(stop - len(expected_chains['noise'])) <= 10
+        assert abs(error(deconvolved[index], image) -
+                   error(expected, image)) < 2e-3
+        for key in ('noise', 'prior'):
+            np.testing.assert_allclose(
+                np.mean(chains[key][15:stop, index]),
+                np.mean(expected_chains[key][15:]), rtol=0.1)
+
+def test_stack_chains():
+    tf.random.set_seed(0)
+    _, noisy = astronaut()
+    _, noisier = astronaut(sigma=0.1, seed=1)
+    _, chains = unspvd_wiener.unsupervised_wiener(
+        np.stack([noisy, noisier]), PSF, user_params={'chains': 3})
+    n = len(chains['noise'])
+    assert chains['noise'].shape == chains['prior'].shape == (n, 2, 3)
+    assert chains['rhat'].shape == chains['iterations'].shape == (2, )
+
+def test_callback():
+    tf.random.set_seed(0)
+    _, noisy = astronaut()
+    batches = []
+    _, chains = unspvd_wiener.unsupervised_wiener(
+        noisy, PSF, user_params={'callback': batches.append, 'thin': 2,
+                                 'callback_every': 5})
+    # callback_every is rounded up to 6 iterations, 3 kept samples
+    n = len(chains['noise'])
+    assert sum(len(batch) for batch in batches) == n - 1
+    assert len(batches) == -(-(n - 1) // 3)
+    for batch in batches[:-1]:
+        assert batch.shape == (3, 256, 129)
+    assert batches[-1].shape[1:] == (256, 129)
+    assert np.iscomplexobj(batches[0])
+
+def test_callback_stack():
+    tf.random.set_seed(0)
+    _, noisy = astronaut()
+    batches = []
+    unspvd_wiener.unsupervised_wiener(
+        np.stack([noisy, noisy]), PSF,
+        user_params={'callback': batches.append, 'chains': 2,
+                     'max_iter': 20, 'callback_every': 10})
+    assert [batch.shape for batch in batches] == [(10, 2, 2, 256, 129)] * 2
+
+def test_callback_error():
+    def callback(samples):
+        raise RuntimeError('callback failed')
+    _, noisy = astronaut()
+    with pytest.raises(RuntimeError, match='callback failed'):
+        unspvd_wiener.unsupervised_wiener(noisy, PSF,
+                                          user_params={'callback': callback})
+
+def test_sampler_error():
+    # an error of the sampler is not masked by the one of the callback
+    def callback(samples):
+        raise RuntimeError('callback failed')
+    gibbs_sampler = unspvd_wiener._gibbs_sampler
+    def failing_sampler(*flags):
+        sampler = gibbs_sampler(*flags)
+        calls = []
+        def run(*args):
+            if calls:
+                raise ValueError('sampler failed')
+            calls.append(args)
+            return sampler(*args)
+        return run
+    _, noisy = astronaut()
+    unspvd_wiener._gibbs_sampler = failing_sampler
+    try:
+        with pytest.raises(ValueError, match='sampler failed'):
+            unspvd_wiener.unsupervised_wiener(
+                noisy, PSF, user_params={'callback': callback})
+    finally:
+        unspvd_wiener._gibbs_sampler = gibbs_sampler
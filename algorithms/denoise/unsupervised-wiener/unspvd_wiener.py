@@ -1,7 +1,18 @@
-import tensorflow.compat.v1 as tf
+import functools
+import os
+import queue
+import sys
+import threading
 
+import numpy as np
+import tensorflow as tf
 
-def ir2tf(imp_resp, shape, sess, dim=None, is_real=True):
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, os.pardir, 'transform', 'fft_padding'))
+from fft_padding import pad_to_fast
+
+
+def ir2tf(imp_resp, shape, dim=None, is_real=True):
     """Compute the transfer function of an impulse response (IR).
     This function makes the necessary correct zero-padding, zero
     convention, correct fft2, etc... to compute the transfer function
@@ -24,30 +35,28 @@ def ir2tf(imp_resp, shape, sess, dim=None, is_real=True):
 
     Returns
     -------
-    y : complex ndarray
+    y : complex tensor
        The transfer function of shape ``shape``.
     """
+    imp_resp = tf.cast(imp_resp, tf.float32)
     if not dim:
         dim = len(imp_resp.shape)
     # Zero padding and fill
-    irpadded = tf.Variable(tf.zeros(shape))
-    sess.run(tf.variables_initializer([irpadded]))
-    sess.run(tf.assign(irpadded[tuple([slice(0, s)
-                                       for s in imp_resp.shape])], imp_resp))
+    imp_shape = tuple(imp_resp.shape)
+    irpadded = tf.pad(imp_resp, [[0, s - i] for s, i in zip(shape, imp_shape)])
 
     # Roll for zero convention of the fft to avoid the phase
     # problem. Work with odd and even size.
-    for axis, axis_size in enumerate(imp_resp.shape):
-        if axis >= len(imp_resp.shape) - dim:
-            irpadded = tf.roll(
-                irpadded, shift=-tf.cast(tf.floor(tf.cast(axis_size, tf.int32) / 2), tf.int32), axis=axis)
+    for axis, axis_size in enumerate(imp_shape):
+        if axis >= len(imp_shape) - dim:
+            irpadded = tf.roll(irpadded, shift=-(axis_size // 2), axis=axis)
     if is_real:
         return tf.signal.rfft2d(irpadded)
     else:
-        return tf.fft2d(tf.cast(irpadded, tf.complex64))
+        return tf.signal.fft2d(tf.cast(irpadded, tf.complex64))
 
 
-def laplacian(ndim, shape, sess, is_real=True):
+def laplacian(ndim, shape, is_real=True):
     """Return the transfer function of the Laplacian.
     Laplacian is the second order difference, on row and column.
 
@@ -64,25 +73,23 @@ def laplacian(ndim, shape, sess, is_real=True):
 
     Returns
     -------
-    tf : array_like, complex
+    tf : complex tensor
         The transfer function.
-    impr : array_like, real
+    impr : tensor, real
         The Laplacian.
     """
-    impr = tf.Variable(tf.zeros([3] * ndim))
-    sess.run(tf.variables_initializer([impr]))
+    impr = np.zeros([3] * ndim, dtype=np.float32)
     for dim in range(ndim):
         idx = tuple([slice(1, 2)] * dim + [slice(None)] +
                     [slice(1, 2)] * (ndim - dim - 1))
-        assign_op = tf.assign(impr[idx], tf.reshape(tf.convert_to_tensor(
-            [-1.0, 0.0, -1.0]), [-1 if i == dim else 1 for i in range(ndim)]))
-        sess.run(assign_op)
-    assign_op = tf.assign(impr[[1] * ndim], 2.0 * ndim)
-    sess.run(assign_op)
-    return ir2tf(impr, shape, sess, is_real=is_real), impr
+        impr[idx] = np.array([-1.0, 0.0, -1.0]).reshape(
+            [-1 if i == dim else 1 for i in range(ndim)])
+    impr[(1, ) * ndim] = 2.0 * ndim
+    impr = tf.constant(impr)
+    return ir2tf(impr, shape, is_real=is_real), impr
 
 
-def image_quad_norm(inarray):
+def image_quad_norm(inarray, is_real=None):
     """Return the quadratic norm of images in Fourier space.
     This function detects whether the input image satisfies the
     Hermitian property.
@@ -92,32 +99,296 @@ def image_quad_norm(inarray):
     inarray : ndarray
         Input image. The image data should reside in the final two
         axes.
+    is_real : boolean, optional
+        True if ``inarray`` is the half spectrum of a real image (rfft2d).
+        Guessed from its last two axes by default, which fails for the
+        full spectrum of a non-square image.
 
     Returns
     -------
     norm : float
         The quadratic norm of ``inarray``.
     """
+    if is_real is None:
+        is_real = inarray.shape[-1] != inarray.shape[-2]
     # If there is a Hermitian symmetry
-    if inarray.shape[-1] != inarray.shape[-2]:
+    if is_real:
         return (2 * tf.reduce_sum(tf.reduce_sum(tf.abs(inarray) ** 2, axis=-1),
                                   axis=-1) - tf.reduce_sum(tf.abs(inarray[..., 0]) ** 2, axis=-1))
     else:
         return tf.reduce_sum(tf.reduce_sum(tf.abs(inarray) ** 2, axis=-1), axis=-1)
 
 
+def _gelman_rubin(count, mean, m2):
+    """Potential scale reduction factor (R-hat) of Gelman and Rubin.
+
+    Parameters
+    ----------
+    count : float tensor
+        The number of samples of each chain.
+    mean, m2 : (..., K) tensors
+        The running (Welford) mean and sum of squared deviations of each
+        of the K chains, for any number of leading parameters.
+
+    Returns
+    -------
+    rhat : (...) tensor
+        The ratio of the pooled to the within-chain standard deviations,
+        close to 1 when the chains have mixed.
+    """
+    within = tf.reduce_mean(m2, axis=-1) / (count - 1)
+    between = tf.math.reduce_variance(mean, axis=-1) * (
+        tf.cast(tf.shape(mean)[-1], tf.float32) /
+        tf.cast(tf.shape(mean)[-1] - 1, tf.float32))
+    pooled = (count - 1) / count * within + between
+    return tf.sqrt(pooled / within)
+
+
+class _CallbackConsumer:
+    """Background thread passing the batches of samples to the user
+    callback, so that the sampler does not wait for it. At most
+    max_pending batches are queued."""
+
+    def __init__(self, callback, axes, max_pending=4):
+        self.callback = callback
+        self.axes = axes
+        self.queue = queue.Queue(max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            samples = self.queue.get()
+            if samples is None:
+                return
+            if self.error is None:
+                try:
+                    self.callback(np.squeeze(samples.numpy(), axis=self.axes))
+                except Exception as error:  # re-raised by close
+                    self.error = error
+
+    def put(self, samples):
+        self.queue.put(samples)
+
+    def close(self, raise_error=True):
+        """Wait for the pending batches and re-raise an error of the
+        callback if raise_error."""
+        self.queue.put(None)
+        self.thread.join()
+        if raise_error and self.error is not None:
+            raise self.error
+
+
+def _initial_state(gn, gx, spectrum_shape):
+    """State of the sampler before the first iteration, for the (N, K)
+    initial hyperparameters of the K chains of N images."""
+    n_images, n_chains = gn.shape
+    return (tf.constant(0), tf.ones([n_images], tf.bool), tf.zeros([n_images], tf.int32),
+            tf.constant(gn), tf.constant(gx),
+            tf.zeros((n_images, n_chains) + tuple(spectrum_shape), tf.complex64),
+            tf.fill([n_images], np.nan),
+            (tf.zeros([2, n_images, n_chains]), tf.zeros([2, n_images, n_chains])),
+            tf.fill([n_images], np.nan))
+
+
+@functools.lru_cache(maxsize=None)
+def _gibbs_sampler(is_real, n_chains, keep_samples):
+    """The Gibbs sampler compiled for the flags which change the structure
+    of its graph. All its other arguments are tensors of a fixed signature,
+    so that the graph is traced once for any image shape, number of images
+    and values of the hyperparameters."""
+    chains = [None, n_chains]
+    state = (tf.TensorSpec([], tf.int32),  # iteration
+             tf.TensorSpec([None], tf.bool),  # active
+             tf.TensorSpec([None], tf.int32),  # iterations
+             tf.TensorSpec(chains, tf.float32),  # gn
+             tf.TensorSpec(chains, tf.float32),  # gx
+             tf.TensorSpec(chains + [None, None], tf.complex64),  # x_postmean
+             tf.TensorSpec([None], tf.float32),  # delta
+             (tf.TensorSpec([2] + chains, tf.float32),) * 2,  # stats
+             tf.TensorSpec([None], tf.float32))  # rhat
+    signature = [state,
+                 tf.TensorSpec([], tf.int32),  # stop
+                 tf.TensorSpec([None, None, None], tf.complex64),  # data_spectrum
+                 tf.TensorSpec([None, None], tf.complex64),  # trans_fct
+                 tf.TensorSpec([None, None], tf.complex64),  # reg
+                 tf.TensorSpec([None, None], tf.float32),  # atf2
+                 tf.TensorSpec([None, None], tf.float32),  # areg2
+                 tf.TensorSpec([], tf.float32),  # size
+                 tf.TensorSpec([], tf.float32),  # threshold
+                 tf.TensorSpec([], tf.int32),  # burnin
+                 tf.TensorSpec([], tf.int32),  # min_iter
+                 tf.TensorSpec([], tf.float32),  # rhat_threshold
+                 tf.TensorSpec([], tf.int32)]  # thin
+    return tf.function(functools.partial(_gibbs_loop, is_real=is_real,
+                                         keep_samples=keep_samples),
+                       input_signature=signature)
+
+
+def _gibbs_loop(state, stop, data_spectrum, trans_fct, reg, atf2, areg2, size,
+                threshold, burnin, min_iter, rhat_threshold, thin, is_real,
+                keep_samples):
+    """The Gibbs sampler as a single loop of the graph, run from a state
+    until the iteration stop, or until all the images have stopped. The
+    sampler runs by chunks of iterations between two callbacks, all the
+    chunks sharing the same graph.
+
+    The N images of the (N, M, P) data_spectrum share the transfer
+    functions and their squared moduli atf2 and areg2, and each one is
+    sampled by K chains. Images and chains are leading batch axes of all
+    the spectra, sampled together by the same FFTs and element-wise
+    operations. The state holds the iteration, the images still running
+    and their numbers of iterations, the (N, K) hyperparameters, the sums
+    of the object samples x_postmean, the stopping criteria delta (of the
+    mean over the chains of each image), the running statistics of the
+    hyperparameter chains after the burn-in and their R-hat. They are
+    loop variables, so that the graph, thus the cost of an iteration, does
+    not grow with the number of iterations, and the kept hyperparameters
+    and samples are accumulated in tensor arrays.
+
+    Every image stops on its own criterion: with several chains, once the
+    R-hat of both its hyperparameters is below rhat_threshold as well. Its
+    state is then frozen by a mask and its chains continue with NaN, while
+    the loop goes on until all the images have stopped.
+
+    Returns the new state, the (n, N, K) noise and prior chains of the
+    iterations i such that (i + 1) is a multiple of thin, and the
+    corresponding (n, N, K, M, P) object samples if keep_samples (empty
+    otherwise).
+    """
+    n_chains = state[3].shape[1]
+    data_spectrum = data_spectrum[:, None]
+    shape = tf.concat([tf.shape(state[3]), tf.shape(data_spectrum)[2:]], 0)
+    nan = tf.fill(tf.shape(state[3]), np.nan)
+
+    def body(iteration, active, iterations, gn, gx, x_postmean, delta, stats, rhat,
+             gn_chain, gx_chain, samples):
+        # Sample of Eq. 27 p(circX^k | gn^k-1, gx^k-1, y).
+
+        # weighting (correlation in direct space)
+        gn_k = gn[..., None, None]
+        precision = gn_k * atf2 + gx[..., None, None] * areg2  # Eq. 29
+        excursion = tf.cast(tf.sqrt(0.5) / tf.sqrt(precision), tf.complex64) * tf.complex(
+            tf.random.normal(shape), tf.random.normal(shape))
+
+        # mean Eq. 30 (RLS for fixed gn, gamma0 and gamma1 ...)
+        wiener_filter = tf.cast(gn_k, tf.complex64) * tf.math.conj(trans_fct) / tf.cast(
+            precision, tf.complex64)
+
+        # sample of X in Fourier space
+        x_sample = wiener_filter * data_spectrum + excursion
+
+        # sample of Eq. 31 p(gn | x^k, gx^k, y), the rate of the gamma
+        # distribution is the inverse of its scale
+        new_gn = tf.random.gamma([], size / 2, beta=image_quad_norm(
+            data_spectrum - x_sample * trans_fct, is_real) / 2)
+
+        # sample of Eq. 31 p(gx | x^k, gn^k-1, y)
+        new_gx = tf.random.gamma([], (size - 1) / 2, beta=image_quad_norm(
+            x_sample * reg, is_real) / 2)
+
+        # the shapes are only known at run time: keep the static number of
+        # chains of the loop variables
+        new_gn = tf.ensure_shape(new_gn, gn.shape)
+        new_gx = tf.ensure_shape(new_gx, gx.shape)
+
+        # current empirical average
+        if_burnt = iteration > burnin
+        new_x_postmean = tf.where(if_burnt, x_postmean + x_sample, x_postmean)
+
+        count = tf.cast(iteration - burnin, tf.float32)
+        current_mean = new_x_postmean / tf.cast(count, tf.complex64)
+        previous_mean = x_postmean / tf.cast(tf.maximum(count - 1, 1), tf.complex64)
+        new_delta = tf.where(
+            iteration > burnin + 1,
+            tf.reduce_sum(tf.abs(current_mean - previous_mean), axis=[1, 2, 3]) /
+            tf.reduce_sum(tf.abs(new_x_postmean), axis=[1, 2, 3]) / count,
+            delta)
+
+        # Welford update of the mean and squared deviations of the chains
+        new_stats, new_rhat = stats, rhat
+        if n_chains > 1:
+            mean, m2 = stats
+            values = tf.stack([new_gn, new_gx])
+            deviation = values - mean
+            new_mean = mean + deviation / tf.maximum(count, 1)
+            new_m2 = m2 + deviation * (values - new_mean)
+            new_stats = (tf.where(if_burnt, new_mean, mean), tf.where(if_burnt, new_m2, m2))
+            new_rhat = tf.where(iteration > burnin + 1,
+                                tf.reduce_max(_gelman_rubin(count, *new_stats), axis=0),
+                                rhat)
+
+        # the images which have stopped keep their state
+        images = active[:, None]
+        gn = tf.where(images, new_gn, gn)
+        gx = tf.where(images, new_gx, gx)
+        x_postmean = tf.where(images[..., None, None], new_x_postmean, x_postmean)
+        delta = tf.where(active, new_delta, delta)
+        stats = tuple(tf.where(images, new, old) for new, old in zip(new_stats, stats))
+        rhat = tf.where(active, new_rhat, rhat)
+        iterations = tf.where(active, iteration + 1, iterations)
+
+        # thinning of the chains and of the samples
+        def keep():
+            slot = gn_chain.size()
+            kept = (gn_chain.write(slot, tf.where(images, new_gn, nan)),
+                    gx_chain.write(slot, tf.where(images, new_gx, nan)))
+            if keep_samples:
+                return kept + (samples.write(slot, x_sample), )
+            return kept + (samples, )
+        gn_chain, gx_chain, samples = tf.cond(
+            tf.equal((iteration + 1) % thin, 0), keep,
+            lambda: (gn_chain, gx_chain, samples))
+
+        # stop of the algorithm for each image
+        found = (iteration > min_iter) & (delta < threshold)
+        if n_chains > 1:
+            found &= rhat < rhat_threshold
+        active &= tf.logical_not(found)
+
+        return (iteration + 1, active, iterations, gn, gx, x_postmean, delta, stats,
+                rhat, gn_chain, gx_chain, samples)
+
+    def cond(iteration, active, *_):
+        return (iteration < stop) & tf.reduce_any(active)
+
+    chains = (tf.TensorArray(tf.float32, size=0, dynamic_size=True,
+                             element_shape=[None, n_chains]),
+              tf.TensorArray(tf.float32, size=0, dynamic_size=True,
+                             element_shape=[None, n_chains]),
+              tf.TensorArray(tf.complex64, size=0, dynamic_size=True))
+    *state, gn_chain, gx_chain, samples = tf.while_loop(
+        cond, body, tuple(state) + chains)
+    if keep_samples:
+        samples = samples.stack()
+    else:
+        samples = tf.zeros([0])
+    return tuple(state), gn_chain.stack(), gx_chain.stack(), samples
+
+
 def unsupervised_wiener(image, psf, reg=None, user_params=None, is_real=True,
-                        clip=True):
+                        clip=True, padding='reflect'):
     """Unsupervised Wiener-Hunt deconvolution.
     Return the deconvolution with a Wiener-Hunt approach, where the
     hyperparameters are automatically estimated. The algorithm is a
     stochastic iterative process (Gibbs sampler) described in the
     reference below. See also ``wiener`` function.
 
+    The whole sampler runs as one loop of a compiled graph, with the
+    hyperparameters, the running mean of the object and the stopping
+    criterion as loop variables, so every iteration costs the same. The
+    chains are stored into arrays preallocated for ``max_iter``
+    iterations.
+
     Parameters
     ----------
-    image : (M, N) ndarray
-       The input degraded image.
+    image : (M, N) or (S, M, N) ndarray
+       The input degraded image, or a stack of S images deconvolved with
+       the same psf and reg. The transfer functions are computed once and
+       the images are sampled together (batched FFTs), each one with its
+       own hyperparameters and stopping criterion: an image which has
+       converged is frozen by a mask while the others go on.
     psf : ndarray
        The impulse response (input image's space) or the transfer
        function (Fourier space). Both are accepted. The transfer
@@ -131,14 +402,26 @@ def unsupervised_wiener(image, psf, reg=None, user_params=None, is_real=True,
     clip : boolean, optional
        True by default. If true, pixel values of the result above 1 or
        under -1 are thresholded for skimage pipeline compatibility.
+    padding : str, optional
+       How the image is extended up to the next sizes with prime factors
+       2, 3, 5 and 7 only, fast for the FFTs: 'reflect' (default),
+       'symmetric' or 'edge' (see ``np.pad``). The transfer functions are
+       computed for the padded shape and the result is cropped. None
+       disables the padding, which is also skipped when psf or reg is a
+       transfer function.
 
     Returns
     -------
-    x_postmean : (M, N) ndarray
-       The deconvolved image (the posterior mean).
+    x_postmean : (M, N) or (S, M, N) ndarray
+       The deconvolved image(s) (the posterior mean).
     chains : dict
-       The keys ``noise`` and ``prior`` contain the chain list of
-       noise and prior precision respectively.
+       The keys ``noise`` and ``prior`` contain the chain arrays of
+       noise and prior precision respectively, of shape (iterations + 1, K)
+       with K chains, or (iterations // thin + 1, K) with thinning. ``rhat`` holds their last R-hat (the largest of
+       the two) with several chains. For a stack, the chains have an
+       image axis after the first one, and continue with NaN after the
+       image has stopped, ``rhat`` is an (S,) array and ``iterations``
+       holds the (S,) numbers of iterations.
 
     Other parameters
     ----------------
@@ -157,10 +440,33 @@ def unsupervised_wiener(image, psf, reg=None, user_params=None, is_real=True,
        satisfied. 200 by default.
     callback : callable (None by default)
        A user provided callable to which is passed, if the function
-       exists, the current image sample for whatever purpose. The user
-       can store the sample, or compute other moments than the
-       mean. It has no influence on the algorithm execution and is
-       only for inspection.
+       exists, the image samples (in Fourier space, as an ndarray) for
+       whatever purpose. The user can store the samples, or compute
+       other moments than the mean. It has no influence on the
+       algorithm execution and is only for inspection. The kept samples
+       (see ``thin``) are passed by batches every ``callback_every``
+       iterations, as an (n, S, K, M, P) array without its axes of
+       length 1 (single image or chain), from a background thread: the
+       sampler goes on meanwhile, unless four batches are pending. An
+       exception of the callback is raised once the sampler has stopped.
+    callback_every : int
+       The number of iterations between two calls to the callback,
+       rounded up to a multiple of ``thin``. 10 by default. The sampler
+       runs by chunks of as many iterations, at once without callback.
+    thin : int
+       Only the samples of every ``thin`` iterations are kept in the
+       chains and passed to the callback. 1 by default. The posterior
+       mean and the stopping criteria use all the samples.
+    chains : int
+       The number K of independent chains, 1 by default. They are
+       sampled together (one batched FFT per iteration), their samples
+       are averaged into the posterior mean, and the sampler only stops
+       once they have mixed: the Gelman-Rubin R-hat of the noise and prior
+       precisions after the burn-in is below ``rhat``. The chains start
+       from hyperparameters spread over two decades around 1.
+    rhat : float
+       The R-hat under which the chains are considered mixed. 1.05 by
+       default.
 
     References
     ----------
@@ -171,154 +477,129 @@ def unsupervised_wiener(image, psf, reg=None, user_params=None, is_real=True,
            https://www.osapublishing.org/josaa/abstract.cfm?URI=josaa-27-7-1593
            http://research.orieux.fr/files/papers/OGR-JOSA10.pdf
     """
-    sess = tf.InteractiveSession()
     params = {'threshold': 1e-4, 'max_iter': 200,
-              'min_iter': 30, 'burnin': 15, 'callback': None}
+              'min_iter': 30, 'burnin': 15, 'callback': None,
+              'chains': 1, 'rhat': 1.05, 'thin': 1, 'callback_every': 10}
     params.update(user_params or {})
 
+    # a stack of images has one more axis
+    image = np.asarray(image)
+    stack = image.ndim == 3
+    crop = None
+    if padding and not np.iscomplexobj(psf) and (reg is None or not np.iscomplexobj(reg)):
+        image, crop = pad_to_fast(image, axes=(-2, -1), mode=padding)
+    shape = image.shape[-2:]
+    size = shape[0] * shape[1]
+
+    # The transfer functions are computed once for all the images
     if reg is None:
-        reg, _ = laplacian(
-            image.ndim, image.shape, sess, is_real=is_real)
-    if reg.dtype != tf.complex64:
-        reg = ir2tf(
-            reg,
-            image.shape,
-            sess,
-            is_real=is_real)
-
-    if psf.shape != reg.shape:
-        trans_fct = ir2tf(
-            psf,
-            image.shape,
-            sess,
-            is_real=is_real)
+        reg, _ = laplacian(2, shape, is_real=is_real)
+    if not np.iscomplexobj(reg):
+        reg = ir2tf(reg, shape, is_real=is_real)
+    reg = tf.cast(reg, tf.complex64)
+
+    if tuple(psf.shape) != tuple(reg.shape):
+        trans_fct = ir2tf(psf, shape, is_real=is_real)
     else:
         trans_fct = psf
-
-    # The mean of the object
-    x_postmean = tf.Variable(
-        tf.cast(
-            tf.zeros(
-                trans_fct.shape),
-            tf.complex64))
-    # The previous computed mean in the iterative loop
-    prev_x_postmean = tf.Variable(
-        tf.cast(tf.zeros(trans_fct.shape), tf.complex64))
-
-    # Difference between two successive mean
-    delta = tf.Variable(1e-8)
-    
-    # Initial state of the chain
-    gn_chain, gx_chain = [
-        tf.constant(1.0)], [
-        tf.constant(1.0)]
-
-    # The correlation of the object in Fourier space (if size is big,
-    # this can reduce computation time in the loop)
-    areg2 = tf.abs(reg) ** 2
-    atf2 = tf.abs(trans_fct) ** 2
+    trans_fct = tf.cast(trans_fct, tf.complex64)
 
     # The Fourier transform may change the image.size attribute, so we
-    # store it.
+    # store it. The transforms are unitary, as in skimage, so that the
+    # precisions are the ones of the image.
+    norm = np.sqrt(size).astype(np.float32)
+    images = image.reshape((-1, ) + shape)
     if is_real:
-        data_spectrum = tf.signal.rfft2d(
-            tf.cast(image, tf.float32))
+        data_spectrum = tf.signal.rfft2d(tf.cast(images, tf.float32)) / norm
     else:
-        data_spectrum = tf.fft2d(
-            tf.cast(image, tf.float32))
-
-    # Gibbs sampling
-    update_prev_x_postmean_op = tf.assign(
-        prev_x_postmean, x_postmean)
-
-    bool_op = tf.cond(
-        delta < params['threshold'],
-        lambda: True,
-        lambda: False)
-
-    # weighting (correlation in direct space)
-    precision = tf.Variable(
-        gn_chain[-1] * atf2 + gx_chain[-1] * areg2)  # Eq. 29
-
-    excursion = tf.Variable(tf.cast(tf.sqrt(0.5) / tf.sqrt(precision), tf.complex64) * (tf.cast(tf.random.normal(
-        data_spectrum.shape), tf.complex64) + 1j * tf.cast(tf.random.normal(data_spectrum.shape), tf.complex64)))
-
-    # mean Eq. 30 (RLS for fixed gn, gamma0 and gamma1 ...)
-    wiener_filter = tf.Variable(tf.cast(
-        gn_chain[-1], tf.complex64) * tf.math.conj(trans_fct) / tf.cast(precision, tf.complex64))
-
-    # sample of X in Fourier space
-    x_sample = tf.Variable(
-        wiener_filter *
-        data_spectrum +
-        excursion)
-
-    # Define oprator for updating variables
-    update_precision_op = tf.assign(
-        precision, gn_chain[-1] * atf2 + gx_chain[-1] * areg2)
-
-    update_excursion_op = tf.assign(excursion, tf.cast(tf.sqrt(0.5) / tf.sqrt(precision), tf.complex64) * (tf.cast(
-        tf.random.normal(data_spectrum.shape), tf.complex64) + \
-        1j * tf.cast(tf.random.normal(data_spectrum.shape), tf.complex64)))
-
-    update_wiener_filter_op = tf.assign(wiener_filter, tf.cast(
-        gn_chain[-1], tf.complex64) * tf.math.conj(trans_fct) / tf.cast(precision, tf.complex64))
-
-    update_x_sample_op = tf.assign(
-        x_sample, wiener_filter * data_spectrum + excursion)
-
-    update_x_postmean_op = tf.assign(
-                x_postmean, prev_x_postmean + x_sample)
+        data_spectrum = tf.signal.fft2d(tf.cast(images, tf.complex64)) / norm
 
-    update_group = tf.group(
-        [update_precision_op, update_excursion_op, update_wiener_filter_op, update_x_sample_op])
-
-    # Initialize variables
-    variable_set_1 = [x_postmean, prev_x_postmean, delta, precision]
-    sess.run(tf.variables_initializer(variable_set_1))
-    variable_set_2 = [excursion, wiener_filter, x_sample]
-    sess.run(tf.variables_initializer(variable_set_2))
-
-    for iteration in range(params['max_iter']):
-        # Sample of Eq. 27 p(circX^k | gn^k-1, gx^k-1, y).
-
-        sess.run(update_group)
-        # sample of X in Fourier space
-        if params['callback']:
-            params['callback'](x_sample)
+    # Initial state of the chains, spread over two decades around 1 with
+    # several chains so that their mixing can be assessed (R-hat)
+    n_chains = params['chains']
+    if n_chains > 1:
+        gn = np.logspace(-1, 1, n_chains, dtype=np.float32)
+    else:
+        gn = np.ones(1, dtype=np.float32)
+    gx = np.tile(gn[::-1], (len(images), 1))
+    gn = np.tile(gn, (len(images), 1))
+
+    # The loop runs by chunks of callback_every iterations (a multiple of
+    # thin) with a callback, whose batches of samples are passed to a
+    # background thread, at once otherwise
+    thin = params['thin']
+    callback = params['callback']
+    if callback:
+        chunk = -(-params['callback_every'] // thin) * thin
+        # without the axes of a single image or chain
+        consumer = _CallbackConsumer(
+            callback, tuple(axis + 1 for axis, n in enumerate(gn.shape) if n == 1))
+    else:
+        chunk = params['max_iter']
 
-        # sample of Eq. 31 p(gn | x^k, gx^k, y)
-        gn_chain.append(tf.random.gamma(shape=[1], alpha=[int(
-            image.size / 2)], beta=image_quad_norm(data_spectrum - x_sample * trans_fct)))
+    # Chains of the kept samples, preallocated for max_iter iterations
+    n_kept = params['max_iter'] // thin + 1
+    gn_chain = np.full((n_kept, ) + gn.shape, np.nan, dtype=np.float32)
+    gx_chain = np.full((n_kept, ) + gx.shape, np.nan, dtype=np.float32)
+    gn_chain[0], gx_chain[0] = gn, gx
+    kept = 1
 
-        # sample of Eq. 31 p(gx | x^k, gn^k-1, y)
-        gx_chain.append(tf.random.gamma(shape=[1], alpha=[int(image.size / 2)],
-                                        beta=image_quad_norm(x_sample * reg)))
-
-        # current empirical average
-        if iteration > params['burnin']:
-            sess.run(update_x_postmean_op)
-
-        if iteration > (params['burnin'] + 1):
-            current = x_postmean / (iteration - params['burnin'])
-            previous = prev_x_postmean / (iteration - params['burnin'] - 1)
-            update_delta_op = tf.assign(delta, (tf.reduce_sum(tf.abs(current - previous)) /
-                                                tf.reduce_sum(tf.abs(x_postmean)) / (iteration - params['burnin'])))
-            sess.run(update_delta_op)
-
-        sess.run(update_prev_x_postmean_op)
-        result_is_found = sess.run(bool_op)
-        # stop of the algorithm
-        if (iteration > params['min_iter']) and result_is_found:
-            break
-
-    # Empirical average \approx POSTMEAN Eq. 44
-    x_postmean = x_postmean / (iteration - params['burnin'])
+    # Gibbs sampling
+    areg2 = tf.abs(reg) ** 2
+    atf2 = tf.abs(trans_fct) ** 2
+    state = _initial_state(gn, gx, data_spectrum.shape[1:])
+    sampler = _gibbs_sampler(bool(is_real), n_chains, bool(callback))
+    hyperparameters = (tf.constant(size, tf.float32),
+                       tf.constant(params['threshold'], tf.float32),
+                       tf.constant(params['burnin'], tf.int32),
+                       tf.constant(params['min_iter'], tf.int32),
+                       tf.constant(params['rhat'], tf.float32),
+                       tf.constant(thin, tf.int32))
+    # an error of the callback is only raised if the sampler has not failed
+    # itself, so as not to mask its exception
+    sampled = False
+    try:
+        while int(state[0]) < params['max_iter'] and bool(tf.reduce_any(state[1])):
+            stop = tf.constant(min(int(state[0]) + chunk, params['max_iter']))
+            state, gn_kept, gx_kept, samples = sampler(
+                state, stop, data_spectrum, trans_fct, reg, atf2, areg2,
+                *hyperparameters)
+            gn_chain[kept:kept + len(gn_kept)] = gn_kept.numpy()
+            gx_chain[kept:kept + len(gx_kept)] = gx_kept.numpy()
+            kept += len(gn_kept)
+            if callback and len(samples):
+                consumer.put(samples)
+        sampled = True
+    finally:
+        if callback:
+            consumer.close(raise_error=sampled)
+    _, _, iterations, _, _, x_postmean, _, _, rhat = state
+    gn_chain, gx_chain = gn_chain[:kept], gx_chain[:kept]
+
+    # Empirical average \approx POSTMEAN Eq. 44, over all the chains of
+    # each image
+    x_postmean = tf.reduce_mean(x_postmean, axis=1) / tf.cast(
+        iterations - 1 - params['burnin'], tf.complex64)[:, None, None]
     if is_real:
-        x_postmean = tf.signal.irfft2d(x_postmean)
+        x_postmean = tf.signal.irfft2d(x_postmean * norm, fft_length=shape)
+    else:
+        x_postmean = tf.math.real(tf.signal.ifft2d(x_postmean * norm))
+    x_postmean = x_postmean.numpy().reshape(image.shape)
+    if crop is not None:
+        x_postmean = x_postmean[crop]
+
+    if clip:
+        x_postmean[x_postmean > 1] = 1
+        x_postmean[x_postmean < -1] = -1
+
+    chains = {'noise': gn_chain, 'prior': gx_chain}
+    if n_chains == 1:
+        chains = {key: chain[..., 0] for key, chain in chains.items()}
+    else:
+        chains['rhat'] = rhat.numpy()
+    if stack:
+        chains['iterations'] = iterations.numpy()
     else:
-        x_postmean = tf.signal.ifft2d(x_postmean)
-    x_postmean = x_postmean.eval()
-    sess.close()
-    
-    return (x_postmean, {'noise': gn_chain, 'prior': gx_chain})
+        chains = {key: chain[:, 0] if chain.ndim > 1 else float(chain[0])
+                  for key, chain in chains.items()}
+    return (x_postmean, chains)
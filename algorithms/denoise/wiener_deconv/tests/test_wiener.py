@@ -2,7 +2,6 @@
 from os.path import abspath, dirname
 from sys import path
 import numpy as np
-import tensorflow as tf
 
 path.append(dirname(dirname(abspath(__file__))))
 
@@ -13,21 +12,146 @@ def test_astronaut():
     image_noise = np.load(dirname(abspath(__file__))+'/astronaut_noise.npy')
     image_desired = np.load(dirname(abspath(__file__))+'/astronaut.npy')
     deconvolved = wiener.wiener(image_noise, psf, 1)
-    np.testing.assert_allclose(deconvolved, image_desired, rtol=1e-3)
+    # the reference was computed with float32 FFTs and holds their round-off,
+    # up to 5e-6: relative to the pixels close to zero, it exceeds 1e-3 even
+    # for a float64 computation, hence atol
+    np.testing.assert_allclose(deconvolved, image_desired, rtol=1e-3, atol=1e-5)
     deconvolved = wiener.wiener(image_noise, psf, 1, is_real=False)
     np.testing.assert_allclose(np.real(deconvolved), image_desired, rtol=1e-3, atol=1e-3)
 
+def test_stack():
+    psf = np.ones((5, 5)) / 25
+    image_noise = np.load(dirname(abspath(__file__))+'/astronaut_noise.npy')
+    image_desired = np.load(dirname(abspath(__file__))+'/astronaut.npy')
+    stack = np.stack([image_noise, 2 * image_noise])
+    deconvolved = wiener.wiener(stack, psf, 1)
+    np.testing.assert_allclose(deconvolved[0], image_desired, rtol=1e-3, atol=1e-5)
+    np.testing.assert_allclose(deconvolved[1], 2 * image_desired, rtol=1e-3, atol=2e-5)
+
+def test_tiled():
+    psf = np.ones((5, 5)) / 25
+    image_noise = np.load(dirname(abspath(__file__))+'/astronaut_noise.npy')
+    deconvolved = wiener.wiener(image_noise, psf, 1)
+    tiled = wiener.wiener_tiled(image_noise, psf, 1, tile_shape=(128, 128),
+                                halo=32, workers=2)
+    inner = (slice(32, -32), ) * 2
+    np.testing.assert_allclose(tiled[inner], deconvolved[inner], atol=1e-3)
+
+def test_padding():
+    # 509 is prime: the image is padded to 512, which is also the shape of
+    # the reference
+    psf = np.ones((5, 5)) / 25
+    image_noise = np.load(dirname(abspath(__file__))+'/astronaut_noise.npy')
+    deconvolved = wiener.wiener(image_noise, psf, 1)[:509, :509]
+    padded = wiener.wiener(image_noise[:509, :509], psf, 1)
+    unpadded = wiener.wiener(image_noise[:509, :509], psf, 1, padding=None)
+    assert padded.shape == unpadded.shape == (509, 509)
+    inner = (slice(32, -32), ) * 2
+    np.testing.assert_allclose(padded[inner], deconvolved[inner], atol=1e-5)
+    np.testing.assert_allclose(unpadded[inner], deconvolved[inner], atol=1e-5)
+
+def test_volume():
+    # a 3-D psf blurs along z too: the 3-D filter inverts it
+    from scipy.ndimage import convolve
+    volume = np.random.RandomState(0).rand(16, 32, 32)
+    kernel = np.array([1., 4., 1.]) / 6
+    psf = kernel[:, None, None] * kernel[None, :, None] * kernel[None, None, :]
+    blurred = convolve(volume, psf, mode='wrap')
+    deconvolved = wiener.wiener(blurred, psf, 1e-9)
+    np.testing.assert_allclose(deconvolved, volume, atol=1e-3)
+
+def _count_ir2tf():
+    """Replace wiener._ir2tf by a wrapper counting its calls."""
+    calls = []
+    ir2tf = wiener._ir2tf
+    def counted(*args, **kwargs):
+        calls.append(args[1])
+        return ir2tf(*args, **kwargs)
+    wiener._ir2tf = counted
+    return calls, ir2tf
+
+def test_cache_hit():
+    wiener.clear_cache()
+    psf = np.ones((3, 3)) / 9
+    image = np.random.RandomState(0).rand(32, 32)
+    calls, ir2tf = _count_ir2tf()
+    try:
+        first = wiener.wiener(image, psf, 1)
+        assert len(calls) == 2  # regularisation and psf
+        second = wiener.wiener(2 * image, psf, 1)
+        assert len(calls) == 2
+    finally:
+        wiener._ir2tf = ir2tf
+    np.testing.assert_allclose(second, 2 * first, rtol=1e-5, atol=1e-6)
+
+def test_cache_miss():
+    wiener.clear_cache()
+    psf = np.ones((3, 3)) / 9
+    image = np.random.RandomState(0).rand(32, 32)
+    calls, ir2tf = _count_ir2tf()
+    try:
+        wiener.wiener(image, psf, 1)
+        size = len(wiener._cache)
+        # a new balance only computes a new filter
+        wiener.wiener(image, psf, 2)
+        assert len(calls) == 2
+        assert len(wiener._cache) == size + 1
+        # new psf content: new psf transfer function and filter
+        wiener.wiener(image, 2 * psf, 1)
+        assert len(calls) == 3
+        # is_real and the shape key everything but the psf content
+        wiener.wiener(image, psf, 1, is_real=False)
+        assert len(calls) == 5
+        wiener.wiener(image[:30, :30], psf, 1, padding=None)
+        assert len(calls) == 7
+    finally:
+        wiener._ir2tf = ir2tf
+
+def test_cache_eviction():
+    wiener.clear_cache()
+    psf = np.ones((3, 3)) / 9
+    image = np.random.RandomState(0).rand(32, 32)
+    cache_size = wiener.CACHE_SIZE
+    wiener.CACHE_SIZE = 4
+    filters = lambda: [key[4] for key in wiener._cache if key[0] == 'filter']
+    try:
+        # the regularisation and psf transfer functions are used by every
+        # filter, so the least recently used filter is evicted
+        for balance in (1, 2, 3):
+            wiener.wiener(image, psf, balance)
+        assert len(wiener._cache) == 4
+        assert filters() == [2, 3]
+        wiener.wiener(image, psf, 1)
+        assert filters() == [3, 1]
+    finally:
+        wiener.CACHE_SIZE = cache_size
+
+def test_clear_cache():
+    psf = np.ones((3, 3)) / 9
+    image = np.random.RandomState(0).rand(32, 32)
+    wiener.wiener(image, psf, 1)
+    wiener.clear_cache()
+    assert len(wiener._cache) == 0
+    calls, ir2tf = _count_ir2tf()
+    try:
+        wiener.wiener(image, psf, 1)
+        assert len(calls) == 2
+    finally:
+        wiener._ir2tf = ir2tf
+
 def test_ir2tf():
-    sess = tf.InteractiveSession()
-    np.testing.assert_allclose(np.array([[4, 0], [0, 0]]), wiener._ir2tf(np.ones((2, 2)), (2, 2), sess).eval())
-    np.testing.assert_allclose((512, 257), (tuple)(tf.shape(wiener._ir2tf(np.ones((2, 2)), (512, 512), sess)).eval()))
-    np.testing.assert_allclose((512, 512), (tuple)(tf.shape(wiener._ir2tf(np.ones((2, 2)), (512, 512), sess, is_real=False)).eval()))
+    np.testing.assert_allclose(np.array([[4, 0], [0, 0]]), wiener._ir2tf(np.ones((2, 2)), (2, 2)))
+    np.testing.assert_allclose((512, 257), tuple(wiener._ir2tf(np.ones((2, 2)), (512, 512)).shape))
+    np.testing.assert_allclose((512, 512), tuple(wiener._ir2tf(np.ones((2, 2)), (512, 512), is_real=False).shape))
 
 def test_laplacian():
-    sess = tf.InteractiveSession()
-    trans, ir = wiener._laplacian(2, (32, 32), sess)
-    np.testing.assert_allclose(np.array([[0, -1, 0], [-1, 4, -1], [0, -1, 0]]), ir.eval())
-    np.testing.assert_allclose(trans.eval(), wiener._ir2tf(ir, (32, 32), sess).eval())
+    trans, ir = wiener._laplacian(2, (32, 32))
+    np.testing.assert_allclose(np.array([[0, -1, 0], [-1, 4, -1], [0, -1, 0]]), ir)
+    np.testing.assert_allclose(trans, wiener._ir2tf(ir, (32, 32)))
+    trans, ir = wiener._laplacian(3, (8, 8, 8))
+    np.testing.assert_allclose(ir[1, 1], [-1, 6, -1])
+    np.testing.assert_allclose(np.sum(ir), 0)
+    np.testing.assert_allclose((8, 8, 5), tuple(trans.shape))
 
 if __name__ == '__main__':
     from numpy import testing
@@ -1,13 +1,68 @@
 #!/usr/bin/env python
 """Wiener Deconvolution, Tensorflow Version
+
+Runs eagerly (TensorFlow 2): no session is created, and the module can be
+used from several threads at once.
 """
 __author__ = "Youwen Mao"
 __email__ = "youwen.mao@uq.net.au"
 __reference__ = ["scikit-image.skimage.restoration.deconvolution", "scikit-image.skimage.restoration.uft"]
 
+import collections
+import concurrent.futures
+import hashlib
+import itertools
+import os
+import sys
+import threading
+
+import numpy as np
 import tensorflow as tf
 
-def _ir2tf(imp_resp, shape, sess, dim=None, is_real=True):
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, os.pardir, 'transform', 'fft_padding'))
+from fft_padding import pad_to_fast
+
+# Maximal number of transfer functions and Wiener filters kept in the cache
+CACHE_SIZE = 32
+_cache = collections.OrderedDict()
+_cache_lock = threading.Lock()
+
+def _array_key(array):
+    """Hashable key of the content of an array or tensor."""
+    array = np.ascontiguousarray(array)
+    digest = hashlib.sha1(array.view(np.uint8)).hexdigest()
+    return (digest, array.shape, array.dtype.str)
+
+def _cached(key, compute):
+    """Return the cached value of key, computing it with compute() on a
+    miss. The least recently used values are evicted beyond CACHE_SIZE.
+    The value is computed outside of the lock: concurrent misses on the
+    same key compute it twice, which is harmless."""
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    value = compute()
+    with _cache_lock:
+        _cache[key] = value
+        if len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return value
+
+def clear_cache():
+    """Empty the cache of transfer functions and Wiener filters."""
+    with _cache_lock:
+        _cache.clear()
+
+# (real, complex) forward and inverse transforms by number of dimensions
+_TRANSFORMS = {
+    1: ((tf.signal.rfft, tf.signal.fft), (tf.signal.irfft, tf.signal.ifft)),
+    2: ((tf.signal.rfft2d, tf.signal.fft2d), (tf.signal.irfft2d, tf.signal.ifft2d)),
+    3: ((tf.signal.rfft3d, tf.signal.fft3d), (tf.signal.irfft3d, tf.signal.ifft3d)),
+}
+
+def _ir2tf(imp_resp, shape, dim=None, is_real=True):
     """Compute the transfer function of an impulse response (IR).
     This function makes the necessary correct zero-padding, zero
     convention, correct fft2, etc... to compute the transfer function
@@ -16,9 +71,8 @@ def _ir2tf(imp_resp, shape, sess, dim=None, is_real=True):
 
     Args:
         imp_resp (ndarray/tensor): he impulse responses.
-        shape (tuple): A tuple of integer corresponding to the target shape of 
+        shape (tuple): A tuple of integer corresponding to the target shape of
             the transfer function.
-        sess (InteractiveSession): Tensorflow session.
         dim (int): The last axis along which to compute the transform. All
             axes by default.
         is_real (boolean): If True (default), imp_resp is supposed real and the
@@ -27,106 +81,231 @@ def _ir2tf(imp_resp, shape, sess, dim=None, is_real=True):
     Return:
         tensor: The transfer function of shape ``shape``.
     """
+    imp_resp = tf.cast(imp_resp, tf.float32)
     if not dim:
-        if tf.contrib.framework.is_tensor(imp_resp):
-            dim = len(imp_resp.shape)
-        else:
-            dim = imp_resp.ndim
-    irpadded = tf.Variable(tf.zeros(shape))
-    init_op = tf.variables_initializer([irpadded])
-    sess.run(init_op)
-    if tf.contrib.framework.is_tensor(imp_resp):
-        imp_shape = tuple(tf.shape(imp_resp).eval())
-    else:
-        imp_shape = imp_resp.shape
-    op = tf.assign(irpadded[tuple([slice(0, s) for s in imp_shape])], imp_resp)
-    sess.run(op)
+        dim = len(imp_resp.shape)
+    imp_shape = tuple(imp_resp.shape)
+    irpadded = tf.pad(imp_resp, [[0, s - i] for s, i in zip(shape, imp_shape)])
     for axis, axis_size in enumerate(imp_shape):
         if axis >= len(imp_resp.shape) - dim:
-            irpadded = tf.manip.roll(irpadded,
-                               shift=-tf.cast(tf.math.floor(axis_size / 2), 
-                               tf.int32),
-                               axis=axis)
-    if dim == 1:
-        return tf.spectral.rfft(irpadded) if is_real else tf.fft(tf.cast(irpadded, tf.complex64))
-    elif dim == 2:
-        return tf.spectral.rfft2d(irpadded) if is_real else tf.fft2d(tf.cast(irpadded, tf.complex64))
-    elif dim == 3:
-        return tf.spectral.rfft3d(irpadded) if is_real else tf.fft3d(tf.cast(irpadded, tf.complex64))
-    else:
+            irpadded = tf.roll(irpadded, shift=-(axis_size // 2), axis=axis)
+    if dim not in _TRANSFORMS:
         raise ValueError('Bad dimension, dim can only be 1, 2 and 3')
+    forward = _TRANSFORMS[dim][0]
+    return forward[0](irpadded) if is_real else forward[1](tf.cast(irpadded, tf.complex64))
 
-def _laplacian(ndim, shape, sess, is_real=True):
+def _laplacian(ndim, shape, is_real=True):
     """Return the transfer function of the Laplacian.
-    Laplacian is the second order difference, on row and column.
+    Laplacian is the second order difference, along every axis.
 
     Args:
         ndim (int): The dimension of the Laplacian.
         shape (tuple): The support on which to compute the transfer function.
-        sess (InteractiveSession): Tensorflow session.
-        is_real (boolean): If True (default), imp_resp is assumed to be 
-            real-valued and the Hermitian property is used with rfftn Fourier 
+        is_real (boolean): If True (default), imp_resp is assumed to be
+            real-valued and the Hermitian property is used with rfftn Fourier
             transform to return the transfer function.
 
     Returns:
-        ndarray: The transfer function.
-        ndarray: The Laplacian.
+        tensor: The transfer function.
+        tensor: The Laplacian.
     """
-    impr = tf.Variable(tf.zeros([3] * ndim))
-    tf.global_variables_initializer().run()
+    impr = np.zeros([3] * ndim, dtype=np.float32)
     for dim in range(ndim):
         idx = tuple([slice(1, 2)] * dim +
                     [slice(None)] +
                     [slice(1, 2)] * (ndim - dim - 1))
+        impr[idx] = np.array([-1.0, 0.0, -1.0]).reshape(
+            [-1 if i == dim else 1 for i in range(ndim)])
+    impr[(1, ) * ndim] = 2.0 * ndim
+    impr = tf.constant(impr)
+    return _ir2tf(impr, shape, is_real=is_real), impr
 
-        op = tf.assign(impr[idx], tf.reshape(
-            tf.convert_to_tensor([-1.0,0.0,-1.0]), 
-            [-1 if i == dim else 1 for i in range(ndim)]))
-        sess.run(op)
-    op = tf.assign(impr[[1]*ndim], 2.0 * ndim)
-    sess.run(op)
-    return _ir2tf(impr, shape, sess, is_real=is_real), impr
-
-def wiener(image, psf, balance, reg=None, is_real=True):
+def wiener(image, psf, balance, reg=None, is_real=True, padding='reflect'):
     """Deconvolution with Wiener filter
-    
+
     Args:
-        image (ndarray): Input degraded image.
-        psf (ndarray): Point Spread Function. This is assumed to be the impulse 
-            response (input image space) if the data-type is real, or the 
-            transfer function (Fourier space) if the data-type is complex. 
-            There is no constraints on the shape of the impulse response. 
-            The transfer function must be of  shape `(M, N)` if `is_real is 
+        image (ndarray): Input degraded signal of 1, 2 or 3 dimensions (as
+            many as the psf), or a stack of N signals with one more leading
+            axis, deconvolved at once with the same psf.
+        psf (ndarray): Point Spread Function. This is assumed to be the impulse
+            response (input image space) if the data-type is real, or the
+            transfer function (Fourier space) if the data-type is complex.
+            There is no constraints on the shape of the impulse response.
+            The transfer function must be of  shape `(M, N)` if `is_real is
             True`, `(M, N // 2 + 1)` otherwise
-        balance(float): The regularisation parameter value that tunes the 
-            balance between the data adequacy that improve frequency 
-            restoration and the prior adequacy that reduce frequency 
+        balance(float): The regularisation parameter value that tunes the
+            balance between the data adequacy that improve frequency
+            restoration and the prior adequacy that reduce frequency
             restoration.
-        reg (tensor): The regularisation operator. The Laplacian by default. 
+        reg (tensor): The regularisation operator. The Laplacian by default.
             It can be an impulse response or a transfer function, as for the
             psf. Shape constraint is the same as for the `psf` parameter.
-        is_real (boolean): True by default. Specify if ``psf`` and ``reg`` are 
-            provided with hermitian hypothesis, that is only half of the 
-            frequency plane is provided (due to the redundancy of Fourier 
-            transform of real signal). It's apply only if ``psf`` and/or 
-            ``reg`` are provided as transfer function. 
+        is_real (boolean): True by default. Specify if ``psf`` and ``reg`` are
+            provided with hermitian hypothesis, that is only half of the
+            frequency plane is provided (due to the redundancy of Fourier
+            transform of real signal). It's apply only if ``psf`` and/or
+            ``reg`` are provided as transfer function.
+        padding (str): How the image is extended up to the next sizes with
+            prime factors 2, 3, 5 and 7 only, fast for the FFTs: 'reflect'
+            (default), 'symmetric' or 'edge' (see np.pad). The transfer
+            functions are computed for the padded shape and the result is
+            cropped. None disables the padding, which is also skipped when
+            psf or reg is a transfer function (its shape is the one of the
+            image).
     Return:
-        ndarray: The predicted original image
+        ndarray: The predicted original image(s)
+
+    The transfer functions of the regularisation and of the psf and the
+    Wiener filter are cached, keyed by the content of psf and reg, the shape
+    of the image, balance and is_real: deconvolving a sequence of images
+    with the same psf only costs two FFTs and a product per image.
     """
-    #TF initialization
-    sess = tf.InteractiveSession()
-    if reg is None:
-        reg, _ = _laplacian(image.ndim, image.shape, sess, is_real=is_real)
-    if (reg.dtype != tf.complex64) & (reg.dtype != tf.complex128):
-        reg = _ir2tf(reg, image.shape, sess, is_real=is_real)
-    if psf.shape != reg.shape:
-        trans_func = _ir2tf(psf, image.shape, sess, is_real=is_real)
-    else:
-        trans_func = psf
-    wiener_filter = tf.conj(trans_func) / (tf.cast((tf.abs(trans_func) ** 2), trans_func.dtype) +
-                                           tf.cast((balance * tf.abs(reg) ** 2), trans_func.dtype))
+    crop = None
+    if padding and not np.iscomplexobj(psf) and (reg is None or not np.iscomplexobj(reg)):
+        image, crop = pad_to_fast(image, range(-len(psf.shape), 0), padding)
+    # a stack has one more axis than the psf
+    shape = tuple(image.shape[-len(psf.shape):])
+    reg_key = ('laplacian', ) if reg is None else _array_key(reg)
+    psf_key = _array_key(psf)
+
+    def regulariser():
+        if reg is None:
+            tf_reg, _ = _laplacian(len(shape), shape, is_real=is_real)
+        else:
+            tf_reg = tf.convert_to_tensor(reg)
+        if not tf_reg.dtype.is_complex:
+            tf_reg = _ir2tf(tf_reg, shape, is_real=is_real)
+        return tf_reg
+
+    def transfer_function():
+        # a psf with the shape of the spectrum is a transfer function
+        spectrum = shape[:-1] + (shape[-1] // 2 + 1, ) if is_real else shape
+        if tuple(psf.shape) != spectrum:
+            return _ir2tf(psf, shape, is_real=is_real)
+        return tf.convert_to_tensor(psf)
+
+    def wiener_filter():
+        tf_reg = _cached(('reg', reg_key, shape, is_real), regulariser)
+        trans_func = _cached(('psf', psf_key, shape, is_real),
+                             transfer_function)
+        return tf.math.conj(trans_func) / (
+            tf.cast((tf.abs(trans_func) ** 2), trans_func.dtype) +
+            tf.cast((balance * tf.abs(tf_reg) ** 2), trans_func.dtype))
+
+    wiener_filter = _cached(('filter', psf_key, reg_key, shape, balance, is_real),
+                            wiener_filter)
+    # the transforms act on the last len(shape) axes, over the whole stack
+    # at once
+    forward, inverse = _TRANSFORMS[len(shape)]
     if is_real:
-        deconv = tf.spectral.irfft2d(wiener_filter * tf.spectral.rfft2d(image))
+        deconv = inverse[0](
+            wiener_filter * forward[0](tf.cast(image, tf.float32)),
+            fft_length=shape)
+    else:
+        deconv = inverse[1](
+            wiener_filter * forward[1](tf.cast(image, tf.complex64)))
+    deconv = deconv.numpy()
+    return deconv if crop is None else deconv[crop]
+
+def _apodised_weights(lo, hi, size, ramp):
+    """Weights along one axis of the core [lo, hi) of a tile, and the range
+    [start, stop) they cover. Across each inner tile boundary the weight
+    falls as a squared cosine over `ramp` pixels while the one of the
+    neighbour rises as a squared sine, so the weights sum to one."""
+    start = max(lo - (ramp + 1) // 2, 0)
+    stop = min(hi + (ramp + 1) // 2, size)
+    centres = np.arange(start, stop) + 0.5
+    weights = np.ones(stop - start)
+    if ramp > 0:
+        if lo > 0:
+            t = np.clip((centres - lo + ramp / 2) / ramp, 0, 1)
+            weights *= np.sin(np.pi / 2 * t) ** 2
+        if hi < size:
+            t = np.clip((hi + ramp / 2 - centres) / ramp, 0, 1)
+            weights *= np.sin(np.pi / 2 * t) ** 2
+    return start, stop, weights
+
+def wiener_tiled(image, psf, balance, reg=None, is_real=True, padding='reflect',
+                 out=None, tile_shape=(1024, 1024), halo=None, workers=None):
+    """Wiener deconvolution of an image too large for a full-frame FFT.
+
+    The image is cut into tiles of shape tile_shape, overlapping by a halo
+    on every side, which are deconvolved with the same cached Wiener filter.
+    The inner parts of the tiles are blended with apodised (squared cosine)
+    weights over `halo` pixels across the tile boundaries. Tiles crossing
+    the border of the image are completed by reflection.
+
+    Args:
+        image (ndarray): Input degraded image, typically memory-mapped
+            (np.load(filename, mmap_mode='r')).
+        psf, balance, reg, is_real, padding: see wiener. reg and a psf given as a
+            transfer function must have the shape of a tile.
+        out (ndarray or str): Array receiving the result, or the name of a
+            .npy file created as a memory-mapped array. A new array by
+            default.
+        tile_shape (tuple): Shape of the tiles, halos included, which sets
+            the size of the FFTs: sizes with prime factors 2, 3, 5 and 7 only
+            avoid the padding of every tile.
+        halo (tuple): Overlap on each side of a tile. By default four times
+            the shape of the psf (the Wiener filter is wider than the psf),
+            or an eighth of the tile for a psf given as transfer function.
+        workers (int): Number of threads deconvolving tiles concurrently,
+            tiles are processed in turn by default.
+    Return:
+        ndarray: The predicted original image, of float32.
+    """
+    ndim = len(tile_shape)
+    if halo is None:
+        if np.iscomplexobj(psf):
+            halo = tuple(t // 8 for t in tile_shape)
+        else:
+            halo = tuple(4 * s for s in psf.shape[-ndim:])
+    elif isinstance(halo, int):
+        halo = (halo, ) * ndim
+    core = tuple(t - 2 * h for t, h in zip(tile_shape, halo))
+    if min(core) <= 0:
+        raise ValueError('the tiles must be larger than twice the halo')
+
+    if out is None:
+        out = np.zeros(image.shape, dtype=np.float32)
+    elif isinstance(out, str):
+        out = np.lib.format.open_memmap(out, mode='w+', dtype=np.float32,
+                                        shape=image.shape)
+    else:
+        out[...] = 0
+    lock = threading.Lock()
+
+    def deconvolve(corner):
+        read, pad, write, local, weights = [], [], [], [], []
+        for lo, n, c, h, t in zip(corner, image.shape, core, halo, tile_shape):
+            first, last = lo - h, lo - h + t
+            read.append(slice(max(first, 0), min(last, n)))
+            pad.append((max(-first, 0), max(last - n, 0)))
+            start, stop, w = _apodised_weights(lo, min(lo + c, n), n, h)
+            write.append(slice(start, stop))
+            local.append(slice(start - first, stop - first))
+            weights.append(w)
+        block = np.asarray(image[tuple(read)], dtype=np.float32)
+        if any(p != (0, 0) for p in pad):
+            block = np.pad(block, pad, mode='reflect')
+        result = wiener(block, psf, balance, reg, is_real, padding)[tuple(local)]
+        if not is_real:
+            result = np.real(result)
+        for axis, w in enumerate(weights):
+            shape = [1] * ndim
+            shape[axis] = -1
+            result = result * w.reshape(shape).astype(np.float32)
+        with lock:
+            out[tuple(write)] += result
+
+    corners = list(itertools.product(*[range(0, n, c) for n, c in zip(image.shape, core)]))
+    if workers:
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            # list() re-raises the exceptions of the tiles
+            list(executor.map(deconvolve, corners))
     else:
-        deconv = tf.spectral.ifft2d(wiener_filter * tf.spectral.fft2d(image))
-    return deconv.eval()
\ No newline at end of file
+        for corner in corners:
+            deconvolve(corner)
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
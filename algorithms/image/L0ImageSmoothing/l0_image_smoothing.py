@@ -15,9 +15,14 @@
 
 # Disable TF logging for INFO and WARN, keep ERROR.
 import os
+import sys
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 import tensorflow as tf
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, os.pardir, 'transform', 'fft_padding'))
+from fft_padding import pad_to_fast
+
 
 def _zero_pad_fxypsf(psf, shape):
     """
@@ -89,7 +94,7 @@ def _fxypsf_to_otf(psf, target):
     return otf
 
 
-def l0_image_smoother(img, _lambda=2e-2, kappa=2.0, beta_max=1e5):
+def l0_image_smoother(img, _lambda=2e-2, kappa=2.0, beta_max=1e5, padding='reflect'):
     """
     Applies L0 Image Smoothing [1] on target img.
 
@@ -115,8 +120,13 @@ def l0_image_smoother(img, _lambda=2e-2, kappa=2.0, beta_max=1e5):
     :param _lambda: Smoothing parameter for degree of smoothness [1]. Default 2e-2.
     :param kappa: Scale rate of smoothing. Default 2.0
     :param beta_max: Parameter to scale max iterations, each iteration increments beta * kappa.
+    :param padding: How the image is extended to the next height and width with prime factors
+                    2, 3, 5 and 7 only, fast for the FFTs: 'reflect' (default), 'symmetric' or
+                    'edge' (see np.pad). The result is cropped back. None disables the padding.
     :return: Numpy array representing the smoothed image.
     """
+    # Pad to fast FFT sizes, the otfs below are computed for the padded shape
+    img, crop = pad_to_fast(img, axes=(0, 1), mode=padding)
     # Store image dimensions for convenience, C is the number of channels
     N, M, C = img.shape
     # Initialise S as float32 of image
@@ -234,7 +244,7 @@ def l0_image_smoother(img, _lambda=2e-2, kappa=2.0, beta_max=1e5):
         print(".", end="", flush=True)
 
     # Rescale
-    S = S.numpy()
+    S = S.numpy()[crop]
     print()
     return S
 
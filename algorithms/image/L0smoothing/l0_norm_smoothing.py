@@ -8,8 +8,15 @@
 #       In ACM Transactions on Graphics (TOG) (Vol. 30, No. 6, p. 174). ACM.
 
 
+import os
+import sys
+
 import tensorflow as tf
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, os.pardir, 'transform', 'fft_padding'))
+from fft_padding import pad_to_fast
+
 # Require tensorflow version >=2.0 to run
 print(tf.__version__)
 
@@ -43,17 +50,22 @@ def psf2otf(psf, outSize):
     return otf
 
 
-def l0_calc(img_arr, _lambda=2e-2, kappa=2.0, beta_max=1e5):
+def l0_calc(img_arr, _lambda=2e-2, kappa=2.0, beta_max=1e5, padding='reflect'):
     """
     Args:
         img_arr: input signal (image in this case)
         _lambda: controls the level of coarseness of the input signal
         kappa: controls the rate. Smaller kappa gives more iterations and images with sharper edges
         beta_max: controls the number of iterations too by determining the interval of convergence
+        padding: how img_arr is extended to the next height and width with prime factors 2, 3, 5
+            and 7 only, fast for the FFTs: 'reflect' (default), 'symmetric' or 'edge' (see
+            np.pad). The output is cropped back. None disables the padding.
 
     Returns:
          output array of the L0 gradient norm of img_arr
     """
+    # pad to fast FFT sizes, the otfs are computed for the padded shape
+    img_arr, crop = pad_to_fast(img_arr, axes=(0, 1), mode=padding)
     (N, M, D) = img_arr.shape
 
     # Initialise and normalise S with image I 
@@ -153,7 +165,7 @@ def l0_calc(img_arr, _lambda=2e-2, kappa=2.0, beta_max=1e5):
     print("Iterations made: %d" % (iterations))
 
     # convert real S values to array
-    output_arr = tf.math.real(S_complex).numpy()
+    output_arr = tf.math.real(S_complex).numpy()[crop]
 
     return output_arr
 
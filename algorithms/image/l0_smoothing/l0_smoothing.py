@@ -1,7 +1,13 @@
+import os
+import sys
 from typing import Callable
 
 import tensorflow as tf
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, os.pardir, 'transform', 'fft_padding'))
+from fft_padding import pad_to_fast
+
 
 def _apply_to_channel(image: tf.Tensor, function: Callable[[tf.Tensor], tf.Tensor]) -> tf.Tensor:
     """Apply a function to each channel in an image (assumes channel last)"""
@@ -38,7 +44,8 @@ def _circulant2_dy(xs: tf.Tensor, dir: int) -> tf.Tensor:
     return shift - xs
 
 
-def l0_gradient_smoothing(image, smoothing_factor: float=0.01, beta_max: int=10000, beta_rate: float=2., max_iterations: int=30) -> tf.Tensor:
+def l0_gradient_smoothing(image, smoothing_factor: float=0.01, beta_max: int=10000, beta_rate: float=2., max_iterations: int=30,
+                          padding: str='reflect') -> tf.Tensor:
     """
     Performs l0 gradient smoothing on the given input data.
     This is essentially a tensorflow port of the code found here: https://github.com/t-suzuki/l0_gradient_minimization_test
@@ -50,8 +57,13 @@ def l0_gradient_smoothing(image, smoothing_factor: float=0.01, beta_max: int=100
     :param beta_max: Termination parameter
     :param beta_rate: The rate at which to grow beta
     :param max_iterations: The maximum number of iterations
+    :param padding: How the image is extended to the next height and width with prime factors 2, 3, 5 and 7 only,
+                    fast for the FFTs: 'reflect' (default), 'symmetric' or 'edge' (see np.pad).
+                    The result is cropped back. None disables the padding.
     :return: Smoothed result
     """
+    # Pad to fast FFT sizes, the transfer functions are computed for the padded shape
+    image, crop = pad_to_fast(image, axes=(0, 1), mode=padding)
     # Ensure that the image is a Tensor
     image = tf.convert_to_tensor(image, tf.float32)
     image = tf.complex(image, tf.zeros_like(image))
@@ -102,4 +114,5 @@ def l0_gradient_smoothing(image, smoothing_factor: float=0.01, beta_max: int=100
         if beta > beta_max:
             break
 
-    return S
+    # Crop the padding, S always has a channel dimension
+    return S[crop[:2]]
@@ -0,0 +1,87 @@
+"""Benchmark of the padding to fast FFT sizes.
+
+Times the Wiener deconvolution and the L0 gradient smoothing of images of
+awkward sizes (with a large prime factor) with and without the padding, and
+a bare 2-D FFT round trip for reference:
+
+    python benchmark.py --size 1021 --size 1031
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from fft_padding import next_fast_len, pad_to_fast
+
+ALGORITHMS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              os.pardir, os.pardir)
+
+def _best_time(func, repeat):
+    """Best wall time of repeat calls, after a warm up call."""
+    func()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def _fft(image, padding):
+    def func():
+        padded, crop = pad_to_fast(image, mode=padding)
+        spectrum = tf.signal.rfft2d(padded)
+        return tf.signal.irfft2d(spectrum, fft_length=padded.shape).numpy()[crop]
+    return func
+
+def _wiener(image, padding):
+    sys.path.append(os.path.join(ALGORITHMS_DIR, 'denoise', 'wiener_deconv'))
+    import wiener
+    psf = np.ones((5, 5)) / 25
+    return lambda: wiener.wiener(image, psf, 1, padding=padding)
+
+def _l0_smoothing(image, padding):
+    sys.path.append(ALGORITHMS_DIR)
+    from image.l0_smoothing.l0_smoothing import l0_gradient_smoothing
+    image = np.stack([image] * 3, -1)
+    return lambda: l0_gradient_smoothing(image, max_iterations=10, padding=padding)
+
+BENCHMARKS = {
+    'fft': _fft,
+    'wiener': _wiener,
+    'l0_smoothing': _l0_smoothing,
+}
+
+def run(names=None, sizes=(1021, 1031, 2039), repeat=3):
+    """Print the times without and with padding of every benchmark and
+    size, and return them as a list of (name, size, unpadded, padded)."""
+    results = []
+    for size in sizes:
+        image = np.random.RandomState(0).rand(size, size).astype(np.float32)
+        for name in names or BENCHMARKS:
+            unpadded = _best_time(BENCHMARKS[name](image, None), repeat)
+            padded = _best_time(BENCHMARKS[name](image, 'reflect'), repeat)
+            results.append((name, size, unpadded, padded))
+            print('{:<14} {:>6} -> {:>6} {:>9.4f} s {:>9.4f} s  x{:.2f}'.format(
+                name, size, next_fast_len(size), unpadded, padded,
+                unpadded / padded))
+    return results
+
+
+##Driver script
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='FFT padding benchmark')
+    parser.add_argument('-b', '--benchmark', action='append',
+                        choices=sorted(BENCHMARKS),
+                        help='benchmark to run (all by default), can be repeated')
+    parser.add_argument('-s', '--size', action='append', type=int,
+                        help='side of the square images (1021, 1031 and 2039 '
+                             'by default), can be repeated')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='number of timed runs, the best one is kept')
+    args = parser.parse_args()
+    print('{:<14} {:>6} -> {:>6} {:>11} {:>11}'.format(
+        'benchmark', 'size', 'padded', 'unpadded', 'padded'))
+    run(args.benchmark, args.size or (1021, 1031, 2039), args.repeat)
@@ -0,0 +1,62 @@
+"""Padding of images to fast FFT sizes.
+
+The FFT of a size with a large prime factor is several times slower than
+the one of a size whose prime factors are all 2, 3, 5 or 7 (a 7-smooth
+size). The images are extended by reflection (or by repeating their edge)
+at the end of the transformed axes, up to the next 7-smooth sizes, processed
+with transfer functions computed for the padded shape, and the results are
+cropped back to the shape of the images.
+"""
+import numpy as np
+
+# Prime factors of the sizes considered fast by the FFT implementations
+FAST_PRIMES = (2, 3, 5, 7)
+
+def is_fast_len(n, primes=FAST_PRIMES):
+    """True if all the prime factors of n are in primes."""
+    for p in primes:
+        while n % p == 0:
+            n //= p
+    return n == 1
+
+def next_fast_len(n, primes=FAST_PRIMES):
+    """Smallest integer larger than or equal to n whose prime factors are all
+    in primes. The 7-smooth integers are dense enough for the search to stop
+    within a few percent of n."""
+    n = max(int(n), 1)
+    while not is_fast_len(n, primes):
+        n += 1
+    return n
+
+def fast_shape(shape, primes=FAST_PRIMES):
+    """The shape with every size replaced by the next fast size."""
+    return tuple(next_fast_len(n, primes) for n in shape)
+
+def pad_to_fast(image, axes=None, mode='reflect', primes=FAST_PRIMES):
+    """Extend an image up to the next fast FFT sizes along some axes.
+
+    Args:
+        image (ndarray/tensor): The image, or a stack of images.
+        axes (iterable): The axes transformed by the FFTs, all of them by
+            default. The other axes (stack, channels) are left alone.
+        mode (str): How the image is extended at the end of the axes, a
+            padding mode of np.pad: 'reflect' (default, no new edge
+            appears), 'symmetric' or 'edge'. None disables the padding.
+        primes (tuple): The prime factors of the fast sizes.
+
+    Returns:
+        ndarray: The padded image (the image itself if its sizes are
+            already fast).
+        tuple: The slices cropping a result of the padded shape back to the
+            shape of the image.
+    """
+    image = np.asarray(image)
+    axes = range(image.ndim) if axes is None else [a % image.ndim for a in axes]
+    pad_width = [(0, 0)] * image.ndim
+    for axis in axes:
+        size = image.shape[axis]
+        pad_width[axis] = (0, next_fast_len(size, primes) - size)
+    crop = tuple(slice(0, n) for n in image.shape)
+    if mode is None or not any(after for _, after in pad_width):
+        return image, crop
+    return np.pad(image, pad_width, mode=mode), crop
@@ -0,0 +1,137 @@
+# Streaming point generator for IFS fractals (Barnsley's fern by default)
+#
+# Points are produced by chunks of float32 (x, y) from the persistent state
+# of many chaos-game chains iterated together with numpy, and can be written
+# straight into a growing .npy file, so the number of points is not bounded
+# by the memory.
+import numpy as np
+
+# Affine maps (x, y) -> (a*x + b*y + e, c*x + d*y + f) as rows [a, b, c, d, e, f]
+BARNSLEY_MAPS = np.array([[0.00, 0.00, 0.00, 0.16, 0.0, 0.00],
+                          [0.85, 0.04, -0.04, 0.85, 0.0, 1.60],
+                          [0.20, -0.26, 0.23, 0.22, 0.0, 1.60],
+                          [-0.15, 0.28, 0.26, 0.24, 0.0, 0.44]])
+BARNSLEY_PROBABILITIES = np.array([0.01, 0.85, 0.07, 0.07])
+
+# The .npy header is written with a fixed size so that it can be rewritten
+# in place with the final number of points once the file is closed.
+NPY_HEADER_SIZE = 128
+
+
+class IFSChain:
+    '''Persistent state of n_chains chaos-game chains iterated together.
+
+    Each call to next_chunk continues the chains where the previous call
+    left them.
+    '''
+    def __init__(self, maps=BARNSLEY_MAPS, probabilities=BARNSLEY_PROBABILITIES,
+                 n_chains=4096, burn_in=20, seed=None):
+        self.maps = np.asarray(maps, dtype=np.float64)
+        probabilities = np.asarray(probabilities, dtype=np.float64)
+        self.cumulative = np.cumsum(probabilities / probabilities.sum())
+        self.rng = np.random.default_rng(seed)
+        self.x = np.zeros(n_chains)
+        self.y = np.zeros(n_chains)
+        # points generated but not returned yet
+        self.pending = np.empty((0, 2), dtype=np.float32)
+        for _ in range(burn_in):
+            self._step()
+
+    def _step(self):
+        '''Apply a randomly chosen map to every chain.'''
+        k = np.searchsorted(self.cumulative, self.rng.random(self.x.size),
+                            side='right')
+        k = np.minimum(k, len(self.maps) - 1)
+        a, b, c, d, e, f = self.maps[k].T
+        self.x, self.y = a*self.x + b*self.y + e, c*self.x + d*self.y + f
+
+    def next_chunk(self, size):
+        '''Return the next size points as a (size, 2) float32 array.'''
+        n_chains = self.x.size
+        n_steps = -(-(size - len(self.pending)) // n_chains)
+        points = np.empty((n_steps, n_chains, 2), dtype=np.float32)
+        for i in range(n_steps):
+            self._step()
+            points[i, :, 0] = self.x
+            points[i, :, 1] = self.y
+        points = np.concatenate([self.pending, points.reshape(-1, 2)])
+        chunk, self.pending = points[:size], points[size:]
+        return chunk
+
+
+def ifs_chunks(chunk_size=2**20, n_points=None, maps=BARNSLEY_MAPS,
+               probabilities=BARNSLEY_PROBABILITIES, chain=None, **kwargs):
+    '''Yield the points of an IFS fractal by (chunk_size, 2) float32 chunks.
+
+    n_points: total number of points, infinite stream if None.
+    chain: IFSChain to continue, a new one is created with maps,
+        probabilities and kwargs (n_chains, burn_in, seed) otherwise.
+    '''
+    if chain is None:
+        chain = IFSChain(maps, probabilities, **kwargs)
+    produced = 0
+    while n_points is None or produced < n_points:
+        size = chunk_size if n_points is None else min(chunk_size, n_points - produced)
+        yield chain.next_chunk(size)
+        produced += size
+
+
+def barnsley_chunks(chunk_size=2**20, n_points=None, **kwargs):
+    '''Yield the points of Barnsley's fern by (chunk_size, 2) float32 chunks.'''
+    return ifs_chunks(chunk_size, n_points, BARNSLEY_MAPS,
+                      BARNSLEY_PROBABILITIES, **kwargs)
+
+
+class NpyWriter:
+    '''Write (n, columns) chunks into a .npy file growing along its first axis.
+
+    The file can be read back with np.load(filename, mmap_mode='r').
+    '''
+    def __init__(self, filename, columns=2, dtype=np.float32):
+        self.filename = filename
+        self.columns = columns
+        self.dtype = np.dtype(dtype)
+        self.rows = 0
+        self.file = open(filename, 'wb')
+        self._write_header()
+
+    def _write_header(self):
+        header = repr({'descr': np.lib.format.dtype_to_descr(self.dtype),
+                       'fortran_order': False,
+                       'shape': (self.rows, self.columns)}).encode('latin1')
+        preamble = np.lib.format.magic(1, 0)
+        length = NPY_HEADER_SIZE - len(preamble) - 2
+        header = header.ljust(length - 1) + b'\n'
+        self.file.seek(0)
+        self.file.write(preamble + np.uint16(length).astype('<u2').tobytes() + header)
+
+    def write(self, chunk):
+        chunk = np.ascontiguousarray(chunk, dtype=self.dtype)
+        if chunk.ndim != 2 or chunk.shape[1] != self.columns:
+            raise ValueError('chunks must be of shape (n, {})'.format(self.columns))
+        self.file.seek(0, 2)
+        self.file.write(chunk.tobytes())
+        self.rows += len(chunk)
+
+    def close(self):
+        if not self.file.closed:
+            self._write_header()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def save_points(filename, chunks):
+    '''Write every chunk of a generator into a .npy file.
+
+    Only one chunk is held in memory at a time. Returns the number of points
+    written.
+    '''
+    with NpyWriter(filename) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+    return writer.rows
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""Throughput benchmark of the fractal generators.
+
+Every (backend, size) case runs in a fresh process, so that its wall time
+and peak memory are not polluted by the previous cases. The results are
+written into a JSON file which can be compared with a previous run:
+
+    python benchmark.py --output new.json --compare old.json
+"""
+import argparse
+import datetime
+import importlib.util
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+
+FRACTALS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _load(directory, name):
+    """Import a fractal module from its directory (several of them are
+    called main.py, so they are loaded under a unique name)."""
+    path = os.path.join(FRACTALS_DIR, directory, name + ".py")
+    sys.path.insert(0, os.path.dirname(path))
+    spec = importlib.util.spec_from_file_location(directory + "." + name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def _barnsley_arrays(size):
+    module = _load("barnsley_fern", "main")
+    return lambda: module.barnsley_arrays(size), size
+
+def _barnsley_tf(size):
+    module = _load("barnsley_fern", "barnsley_fern_tf")
+    return lambda: module.barnsley_tf(size), size
+
+def _barnsley_chunks(size):
+    module = _load("barnsley_fern", "ifs_stream")
+    def func():
+        for _ in module.barnsley_chunks(2**20, size):
+            pass
+    return func, size
+
+def _lyapunov(size, nb_iters=100):
+    import numpy as np
+    module = _load("lyapunov_fractal", "lyapunov")
+    a, b = np.meshgrid(np.linspace(2, 4, size), np.linspace(2, 4, size),
+                       indexing="ij")
+    module.lyapunov_exponent(0.5, a[:2, :2], b[:2, :2], 1) # trace once
+    return (lambda: module.lyapunov_exponent(0.5, a, b, nb_iters),
+            size*size*nb_iters)
+
+# name: (setup, unit of the throughput, default sizes)
+# setup(size) imports the backend and returns the function to time and the
+# amount of work it does.
+BENCHMARKS = {
+    "barnsley_arrays": (_barnsley_arrays, "points/s", [10**4, 10**5, 10**6]),
+    "barnsley_tf": (_barnsley_tf, "points/s", [10**3, 10**4]),
+    "barnsley_chunks": (_barnsley_chunks, "points/s", [10**6, 10**7, 10**8]),
+    "lyapunov_exponent": (_lyapunov, "pixels*iterations/s", [128, 256, 512]),
+}
+
+def _peak_rss_mb():
+    """Peak resident set size of the current process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+def _run_case(name, size, repeat, queue):
+    setup, unit, _ = BENCHMARKS[name]
+    func, work = setup(size)
+    baseline_mb = _peak_rss_mb()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    wall_time = min(times)
+    queue.put({"benchmark": name,
+               "size": size,
+               "wall_time_s": wall_time,
+               "wall_times_s": times,
+               "peak_memory_mb": _peak_rss_mb(),
+               "peak_memory_increase_mb": _peak_rss_mb() - baseline_mb,
+               "throughput": work / wall_time,
+               "unit": unit})
+
+def run_case(name, size, repeat=3):
+    """Run one case in a fresh process and return its results."""
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_run_case, args=(name, size, repeat, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+def _versions():
+    versions = {"python": platform.python_version()}
+    for package in ("numpy", "tensorflow"):
+        try:
+            versions[package] = __import__(package).__version__
+        except ImportError:
+            versions[package] = None
+    return versions
+
+def run(names=None, sizes=None, repeat=3, verbose=True):
+    """Run the benchmarks and return the report as a dictionary."""
+    results = []
+    for name in names or BENCHMARKS:
+        for size in sizes or BENCHMARKS[name][2]:
+            result = run_case(name, size, repeat)
+            results.append(result)
+            if verbose:
+                print("{:<20} {:>10} {:>10.3f} s {:>12.4g} {} {:>9.1f} MB".format(
+                    name, size, result["wall_time_s"], result["throughput"],
+                    result["unit"], result["peak_memory_mb"]))
+    return {"date": datetime.datetime.now().isoformat(),
+            "machine": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "versions": _versions(),
+            "results": results}
+
+def compare(report, reference):
+    """Print the throughput ratio of each case against a previous report."""
+    previous = {(r["benchmark"], r["size"]): r for r in reference["results"]}
+    for result in report["results"]:
+        old = previous.get((result["benchmark"], result["size"]))
+        if old is not None:
+            print("{:<20} {:>10} throughput x{:.2f}, peak memory x{:.2f}".format(
+                result["benchmark"], result["size"],
+                result["throughput"] / old["throughput"],
+                result["peak_memory_mb"] / old["peak_memory_mb"]))
+
+
+##Driver script
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fractal throughput benchmark")
+    parser.add_argument("-b", "--benchmark", action="append",
+                        choices=sorted(BENCHMARKS),
+                        help="benchmark to run (all by default), can be repeated")
+    parser.add_argument("-s", "--size", action="append", type=int,
+                        help="problem size (default sizes of each benchmark "
+                             "otherwise), can be repeated")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="number of timed runs, the best one is kept")
+    parser.add_argument("-o", "--output", default="benchmark.json",
+                        help="JSON file for the results")
+    parser.add_argument("-c", "--compare",
+                        help="JSON file of a previous run to compare with")
+    args = parser.parse_args()
+
+    report = run(args.benchmark, args.size, args.repeat)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
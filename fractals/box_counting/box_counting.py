@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""Box-counting and correlation dimension of point clouds and binary masks.
+
+The points are quantized once on a 2^L grid and encoded as Morton codes
+(the bits of the coordinates interleaved). The box of a point at the scale
+2^s is then simply its code shifted right by d*s bits, and the shifted codes
+stay sorted, so a single sort of the finest-scale codes gives the occupied
+boxes and their occupancy at every scale.
+"""
+import collections
+
+import numpy as np
+from scipy import stats
+
+# Number of points quantized at once
+CHUNK_SIZE = 2**16
+
+DimensionEstimate = collections.namedtuple(
+    "DimensionEstimate",
+    ["dimension", "stderr", "interval", "log_inv_sizes", "log_values", "fit"])
+
+# Shifts and masks spreading the bits of a coordinate for 2 and 3 dimensions
+_SPREAD_MASKS = {
+    2: [(16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF),
+        (4, 0x0F0F0F0F0F0F0F0F), (2, 0x3333333333333333),
+        (1, 0x5555555555555555)],
+    3: [(32, 0x001F00000000FFFF), (16, 0x001F0000FF0000FF),
+        (8, 0x100F00F00F00F00F), (4, 0x10C30C30C30C30C3),
+        (2, 0x1249249249249249)],
+}
+
+def _spread_bits(x, ndim, nbits):
+    """Insert ndim - 1 zero bits between the nbits low bits of x."""
+    x = x.astype(np.uint64)
+    if ndim in _SPREAD_MASKS:
+        tmp = np.empty_like(x)
+        for shift, mask in _SPREAD_MASKS[ndim]:
+            np.left_shift(x, np.uint64(shift), out=tmp)
+            x |= tmp
+            x &= np.uint64(mask)
+        return x
+    out = np.zeros_like(x)
+    for bit in range(nbits):
+        out |= ((x >> np.uint64(bit)) & np.uint64(1)) << np.uint64(bit*ndim)
+    return out
+
+def morton_codes(coords, nbits):
+    """Morton codes of (N, d) non-negative integer coordinates of nbits bits."""
+    coords = np.asarray(coords)
+    ndim = coords.shape[1]
+    if ndim*nbits > 64:
+        raise ValueError("{} bits per axis do not fit a 64 bits code in {} "
+                         "dimensions".format(nbits, ndim))
+    codes = np.zeros(len(coords), dtype=np.uint64)
+    for axis in range(ndim):
+        spread = _spread_bits(coords[:, axis], ndim, nbits)
+        spread <<= np.uint64(axis)
+        codes |= spread
+    return codes
+
+def _bounds(data):
+    """Lowest corner and largest side of the bounding box of the points."""
+    # column by column: much faster than reducing along axis 0
+    low = np.array([data[:, axis].min() for axis in range(data.shape[1])],
+                   dtype=np.float64)
+    high = np.array([data[:, axis].max() for axis in range(data.shape[1])],
+                    dtype=np.float64)
+    return low, float((high - low).max()) or 1.
+
+def quantize(points, nbits, low, extent):
+    """Map points of the box [low, low + extent) onto [0, 2^nbits) along
+    every axis (same scale on all axes), as integer coordinates."""
+    scale = 2**nbits / extent
+    coords = np.minimum((points - low) * scale, 2**nbits - 1)
+    return coords.astype(np.uint32 if nbits <= 32 else np.uint64)
+
+def finest_codes(data, nbits=None):
+    """Morton codes of the points or of the pixels of a mask on the finest
+    grid.
+
+    Args:
+        data (ndarray): (N, d) array of points, or a boolean mask of any
+            dimension (its True pixels are the points).
+        nbits (int): number of bits per axis of the finest grid. The bounding
+            box of the points is mapped onto [0, 2^nbits) along every axis,
+            with by default about N cells in total, a point per cell. For a
+            mask, the pixels are used directly and nbits defaults to
+            the number of bits of its largest axis.
+
+    Returns:
+        ndarray: the codes, as uint64.
+        int: nbits.
+        int: the dimension d.
+    """
+    data = np.asarray(data)
+    if data.dtype == bool:
+        if nbits is None:
+            nbits = max(int(np.ceil(np.log2(max(data.shape)))), 1)
+        coords = np.stack(np.nonzero(data), axis=1)
+        return morton_codes(coords, nbits), nbits, data.ndim
+
+    ndim = data.shape[1]
+    if nbits is None:
+        # finer grids would mostly hold one point per box
+        nbits = min(64 // ndim, max(int(np.ceil(np.log2(len(data)) / ndim)) + 1, 4))
+    low, extent = _bounds(data)
+    codes = np.empty(len(data), dtype=np.uint64)
+    # by chunks, to keep the temporaries small and in cache
+    for start in range(0, len(data), CHUNK_SIZE):
+        coords = quantize(data[start:start + CHUNK_SIZE], nbits, low, extent)
+        codes[start:start + CHUNK_SIZE] = morton_codes(coords, nbits)
+    return codes, nbits, ndim
+
+def _run_starts(codes):
+    """Indices of the first element of each run of equal sorted codes."""
+    starts = np.flatnonzero(codes[1:] != codes[:-1])
+    starts += 1
+    return np.concatenate(([0], starts))
+
+def box_counts(data, nbits=None):
+    """Occupied boxes at every scale, from a single sort.
+
+    Args:
+        data, nbits: see finest_codes.
+
+    Returns:
+        ndarray: box sizes 2^s (in finest grid cells) for s = 0..nbits.
+        ndarray: number of occupied boxes at each size.
+        ndarray: sum of the squared occupancies at each size divided by N^2,
+            i.e. the probability that two points share a box (correlation
+            sum).
+    """
+    codes, nbits, ndim = finest_codes(data, nbits)
+    npoints = len(codes)
+    codes.sort()
+    starts = _run_starts(codes)
+    occupancy = np.diff(starts, append=npoints)
+    codes = codes[starts]
+
+    sizes = 2**np.arange(nbits + 1)
+    counts = np.empty(nbits + 1, dtype=np.int64)
+    correlations = np.empty(nbits + 1)
+    for s in range(nbits + 1):
+        if s > 0:
+            # merge the boxes of the previous scale sharing the same parent
+            codes = codes >> np.uint64(ndim)
+            starts = _run_starts(codes)
+            codes = codes[starts]
+            occupancy = np.add.reduceat(occupancy, starts)
+        counts[s] = len(codes)
+        correlations[s] = np.sum(occupancy.astype(np.float64)**2) / float(npoints)**2
+    return sizes, counts, correlations
+
+def _estimate(log_inv_sizes, log_values, confidence):
+    """Least squares slope with its standard error and confidence interval."""
+    fit, cov = np.polyfit(log_inv_sizes, log_values, 1, cov="unscaled")
+    residuals = log_values - np.polyval(fit, log_inv_sizes)
+    dof = len(log_values) - 2
+    if dof > 0:
+        stderr = np.sqrt(np.sum(residuals**2) / dof * cov[0, 0])
+        half_width = stats.t.ppf(0.5 + confidence/2, dof) * stderr
+    else:
+        stderr = half_width = np.nan
+    return DimensionEstimate(fit[0], stderr,
+                             (fit[0] - half_width, fit[0] + half_width),
+                             log_inv_sizes, log_values, fit)
+
+def _fit_range(counts, scales, is_mask, min_boxes=64):
+    """Scales used for the fit. By default, leave out the coarse scales with
+    less than min_boxes boxes and, for point clouds, the fine scales where
+    the boxes are not resolved (more than a quarter as many boxes as at the
+    finest scale). The pixels of a mask are resolved at every scale."""
+    if scales is not None:
+        return np.arange(*scales)
+    used = counts >= min_boxes
+    if not is_mask:
+        used &= counts < counts[0] / 4
+    used = np.flatnonzero(used)
+    if len(used) < 3:
+        used = np.arange(1, len(counts) - 1)
+    return used
+
+def box_counting_dimension(data, nbits=None, scales=None, confidence=0.95):
+    """Box-counting (capacity) dimension of points or of a binary mask.
+
+    The dimension is the slope of log N(eps) against log(1/eps), where
+    N(eps) is the number of boxes of size eps holding at least one point.
+
+    Args:
+        data, nbits: see finest_codes.
+        scales (tuple): (first, last) range of the scale exponents s (boxes
+            of 2^s finest cells) used in the fit, automatic by default.
+        confidence (float): level of the confidence interval.
+
+    Returns:
+        DimensionEstimate: dimension, its standard error, the confidence
+            interval, the fitted log(1/eps) and log N(eps), and the fitted
+            polynomial (slope, intercept).
+    """
+    data = np.asarray(data)
+    sizes, counts, _ = box_counts(data, nbits)
+    used = _fit_range(counts, scales, data.dtype == bool)
+    return _estimate(-np.log(sizes[used].astype(np.float64)),
+                     np.log(counts[used].astype(np.float64)), confidence)
+
+def correlation_dimension(data, nbits=None, scales=None, confidence=0.95):
+    """Correlation dimension of points or of a binary mask.
+
+    The dimension is the slope of log C(eps) against log(eps), where C(eps)
+    is the probability that two points fall into the same box of size eps
+    (box-assisted estimate of the correlation integral).
+
+    Args and Returns: see box_counting_dimension. log_values holds
+        log C(eps) and the slope is taken against log(eps).
+    """
+    data = np.asarray(data)
+    sizes, counts, correlations = box_counts(data, nbits)
+    used = _fit_range(counts, scales, data.dtype == bool)
+    return _estimate(np.log(sizes[used].astype(np.float64)),
+                     np.log(correlations[used]), confidence)
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+
+import numpy as np
+import matplotlib.pyplot as plt
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "barnsley_fern"))
+from ifs_stream import barnsley_chunks
+
+import box_counting
+
+def plot(estimate, xlabel, ylabel, title):
+    plt.figure(figsize=(7, 5))
+    plt.plot(estimate.log_inv_sizes, estimate.log_values, "o")
+    plt.plot(estimate.log_inv_sizes, np.polyval(estimate.fit, estimate.log_inv_sizes))
+    plt.xlabel(xlabel)
+    plt.ylabel(ylabel)
+    plt.title("{}: {:.3f} [{:.3f}, {:.3f}]".format(title, estimate.dimension,
+                                                  *estimate.interval))
+    plt.show()
+
+
+##Driver script
+if __name__ == "__main__":
+    # Barnsley's fern, 10^7 points
+    points = np.concatenate(list(barnsley_chunks(n_points=10**7, seed=0)))
+
+    estimate = box_counting.box_counting_dimension(points)
+    plot(estimate, "log(1/eps)", "log N(eps)", "Box-counting dimension")
+
+    estimate = box_counting.correlation_dimension(points)
+    plot(estimate, "log(eps)", "log C(eps)", "Correlation dimension")
@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+from os.path import abspath, dirname
+from sys import path
+import numpy as np
+
+path.append(dirname(dirname(abspath(__file__))))
+
+import box_counting
+
+def test_solid_cube():
+    mask = np.ones((40, 40, 40), dtype=bool)
+    estimate = box_counting.box_counting_dimension(mask)
+    np.testing.assert_allclose(estimate.dimension, 3, atol=0.05)
+    estimate = box_counting.correlation_dimension(mask)
+    np.testing.assert_allclose(estimate.dimension, 3, atol=0.05)
+
+def test_solid_square():
+    mask = np.ones((100, 100), dtype=bool)
+    estimate = box_counting.box_counting_dimension(mask)
+    np.testing.assert_allclose(estimate.dimension, 2, atol=0.05)
+    estimate = box_counting.correlation_dimension(mask)
+    np.testing.assert_allclose(estimate.dimension, 2, atol=0.05)
+
+def test_uniform_points():
+    points = np.random.default_rng(0).random((10**5, 2))
+    estimate = box_counting.box_counting_dimension(points)
+    np.testing.assert_allclose(estimate.dimension, 2, atol=0.05)
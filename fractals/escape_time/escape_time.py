@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""Escape-time fractals: Mandelbrot and Julia sets.
+
+The whole complex grid is iterated at once. Only the pixels which have
+neither escaped nor been proven interior are kept in the active set, which
+is compacted as pixels leave it, so the cost of an iteration is proportional
+to the number of pixels still undecided.
+
+Images have the imaginary axis along the rows (top row = largest imaginary
+part) and the real axis along the columns, sampled at the pixel centres.
+Escaped pixels hold a smooth (continuous) iteration count, interior pixels
+hold NaN.
+"""
+import numpy as np
+
+def _grid(extent, shape, rows=slice(None), cols=slice(None)):
+    """Complex coordinates of the pixel centres of (a part of) the image."""
+    x0, x1, y0, y1 = extent
+    height, width = shape
+    i = np.arange(height)[rows]
+    j = np.arange(width)[cols]
+    x = x0 + (j + 0.5)*(x1 - x0)/width
+    y = y1 - (i + 0.5)*(y1 - y0)/height
+    return x[np.newaxis, :] + 1j*y[:, np.newaxis]
+
+def _mandelbrot_interior(c):
+    """True for the points of the main cardioid and of the period-2 bulb."""
+    x, y = c.real, c.imag
+    q = (x - 0.25)**2 + y**2
+    cardioid = q*(q + (x - 0.25)) <= 0.25*y**2
+    bulb = (x + 1)**2 + y**2 <= 1/16
+    return cardioid | bulb
+
+def escape_time(z0, c, max_iter=256, bailout=256., periodicity_check=True,
+                periodicity_eps=1e-12):
+    """Iterate z -> z^2 + c from z0 on whole arrays.
+
+    Args:
+        z0 (ndarray): starting points.
+        c (ndarray or complex): parameters, broadcastable to z0.
+        max_iter (int): maximal number of iterations.
+        bailout (float): escape radius. A large radius gives a smoother
+            colouring.
+        periodicity_check (bool): detect the orbits falling into a cycle and
+            stop iterating them (they are interior).
+        periodicity_eps (float): distance under which an orbit is considered
+            back to a previous point.
+
+    Returns:
+        ndarray: smooth iteration count of the escaped points, NaN for the
+            interior points (and for the points not escaped after max_iter
+            iterations).
+    """
+    z = np.array(z0, dtype=np.complex128)
+    c = np.broadcast_to(np.asarray(c, dtype=np.complex128), z.shape)
+    out = np.full(z.shape, np.nan)
+
+    # Active set, flattened
+    index = np.arange(z.size)
+    z = z.ravel().copy()
+    c = c.ravel().copy()
+    out_flat = out.ravel()
+
+    bailout2 = bailout**2
+    eps2 = periodicity_eps**2
+    z_old = z.copy()
+    next_check = 1
+    for n in range(max_iter):
+        z = z*z + c
+        abs2 = z.real**2 + z.imag**2
+
+        escaped = abs2 > bailout2
+        if periodicity_check:
+            diff = z - z_old
+            cycling = diff.real**2 + diff.imag**2 < eps2
+            done = escaped | cycling
+        else:
+            done = escaped
+
+        if escaped.any():
+            # Smooth colouring: n + 1 - log2(log|z|)
+            log_abs = 0.5*np.log(abs2[escaped])
+            out_flat[index[escaped]] = n + 1 - np.log2(log_abs)
+
+        if done.any():
+            keep = ~done
+            index = index[keep]
+            z = z[keep]
+            c = c[keep]
+            z_old = z_old[keep]
+            if index.size == 0:
+                break
+
+        # Brent-like periodicity check: the reference point is refreshed
+        # at doubling intervals so that cycles of any period are caught.
+        if periodicity_check and n + 1 == next_check:
+            z_old = z.copy()
+            next_check *= 2
+
+    return out
+
+def mandelbrot(extent=(-2.5, 1., -1.25, 1.25), shape=(1000, 1400),
+               max_iter=256, bailout=256., periodicity_check=True,
+               interior_test=True, rows=slice(None), cols=slice(None)):
+    """Render the Mandelbrot set.
+
+    Args:
+        extent (tuple): (xmin, xmax, ymin, ymax) of the image in the complex
+            plane.
+        shape (tuple): (height, width) of the image in pixels.
+        max_iter, bailout, periodicity_check: see escape_time.
+        interior_test (bool): skip the pixels of the main cardioid and of
+            the period-2 bulb, known to be interior.
+        rows, cols (slice): only render this part of the image.
+
+    Returns:
+        ndarray: smooth iteration counts, NaN inside the set.
+    """
+    c = _grid(extent, shape, rows, cols)
+    out = np.full(c.shape, np.nan)
+    if interior_test:
+        todo = ~_mandelbrot_interior(c)
+    else:
+        todo = np.ones(c.shape, dtype=bool)
+    out[todo] = escape_time(np.zeros(np.count_nonzero(todo)), c[todo],
+                            max_iter, bailout, periodicity_check)
+    return out
+
+def julia(c, extent=(-1.6, 1.6, -1.2, 1.2), shape=(1000, 1333), max_iter=256,
+          bailout=256., periodicity_check=True, rows=slice(None),
+          cols=slice(None)):
+    """Render the Julia set of parameter c.
+
+    Args:
+        c (complex): parameter of the Julia set.
+        other arguments: see mandelbrot.
+
+    Returns:
+        ndarray: smooth iteration counts, NaN inside the filled Julia set.
+    """
+    z0 = _grid(extent, shape, rows, cols)
+    return escape_time(z0, c, max_iter, bailout, periodicity_check)
+
+def render_tiled(filename, extent, shape, c=None, tile_shape=(1024, 1024),
+                 **kwargs):
+    """Render a large Mandelbrot (c is None) or Julia image tile by tile.
+
+    The image is written into a memory-mapped .npy file, so only one tile
+    is held in memory at a time.
+
+    Args:
+        filename (str): path of the .npy file to create.
+        extent, shape: see mandelbrot.
+        c (complex): parameter of the Julia set, None for the Mandelbrot set.
+        tile_shape (tuple): (height, width) of the tiles.
+        kwargs: passed to mandelbrot or julia.
+
+    Returns:
+        memmap: the rendered image, of dtype float32.
+    """
+    out = np.lib.format.open_memmap(filename, mode="w+", dtype=np.float32,
+                                    shape=tuple(shape))
+    for i in range(0, shape[0], tile_shape[0]):
+        for j in range(0, shape[1], tile_shape[1]):
+            rows = slice(i, min(i + tile_shape[0], shape[0]))
+            cols = slice(j, min(j + tile_shape[1], shape[1]))
+            if c is None:
+                tile = mandelbrot(extent, shape, rows=rows, cols=cols, **kwargs)
+            else:
+                tile = julia(c, extent, shape, rows=rows, cols=cols, **kwargs)
+            out[rows, cols] = tile
+    out.flush()
+    return out
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import matplotlib.pyplot as plt
+
+import escape_time
+
+def plot(image, extent, title):
+    cmap = plt.get_cmap("twilight_shifted").copy()
+    cmap.set_bad("black") # interior points are NaN
+    plt.figure(figsize=(10, 7))
+    plt.imshow(np.log(image), extent=extent, cmap=cmap)
+    plt.title(title)
+    plt.show()
+
+
+##Driver script
+if __name__ == "__main__":
+    # Parameters
+    max_iter = 500
+    shape = (1000, 1400)
+
+    extent = (-2.5, 1., -1.25, 1.25)
+    image = escape_time.mandelbrot(extent, shape, max_iter)
+    plot(image, extent, "Mandelbrot set")
+
+    c = -0.8 + 0.156j
+    extent = (-1.6, 1.6, -1.2, 1.2)
+    image = escape_time.julia(c, extent, shape, max_iter)
+    plot(image, extent, "Julia set, c = {}".format(c))
+
+    # Large images are rendered tile by tile into a memory-mapped file
+    #image = escape_time.render_tiled("mandelbrot.npy", (-2.5, 1., -1.25, 1.25),
+    #                                 (20000, 28000), max_iter=max_iter)
@@ -4,37 +4,83 @@
 import tensorflow as tf
 import numpy as np
 
-##Lyapunov fractal
-def lyapunov_exponent(P0, a, b, nb_iters):
-    sess = tf.InteractiveSession()
+# Products of derivatives are renormalised at every step by the exact power of
+# two of their magnitude (as frexp does), so that a block of any number of
+# steps can be multiplied together without underflow or overflow.
+LOG2 = np.log(2.)
+
+def _sequence_step(atf, btf, is_a, i, Pn, rate):
+    """Step i of the sequence, where rate is the rate of this step.
+
+    Returns the new population, the derivative of the following map at this
+    population and the rate of the following map."""
+    next_rate = tf.cond(is_a[(i+1) % tf.size(is_a)], lambda: atf, lambda: btf)
+    Pn = rate*Pn*(1-Pn)
+    return Pn, next_rate*(1-2*Pn), next_rate
 
-    atf = tf.Variable(a.astype(np.float32))
-    btf = tf.Variable(b.astype(np.float32))
-    Pn = tf.Variable(tf.fill(tf.shape(a), P0))
-    n = tf.Variable([0.])
-    E = tf.Variable(tf.zeros_like(Pn, tf.float32))
+def _renormalise(prod, scale):
+    """Divide prod by the power of two of its magnitude, adding the exponent
+    to scale. Zero products are left as they are."""
+    exponent = tf.math.floor(tf.math.log(tf.abs(prod))/LOG2)
+    exponent = tf.where(prod == 0, tf.zeros_like(prod), exponent)
+    return prod/tf.pow(2., exponent), scale + exponent
 
-    tf.global_variables_initializer().run() #init variables
+@tf.function(input_signature=[tf.TensorSpec(None, tf.float32), # a
+                              tf.TensorSpec(None, tf.float32), # b
+                              tf.TensorSpec([None], tf.bool), # sequence
+                              tf.TensorSpec([], tf.float32), # P0
+                              tf.TensorSpec([], tf.int32), # nb_iters
+                              tf.TensorSpec([], tf.int32), # nb_transient
+                              tf.TensorSpec([], tf.int32)]) # block_size
+def _lyapunov_loop(atf, btf, is_a, P0, nb_iters, nb_transient, block_size):
+    """Whole Lyapunov iteration, compiled once into a single graph."""
+    length = tf.size(is_a)
+    Pn = tf.fill(tf.shape(atf), P0)
+    rate = tf.cond(is_a[0], lambda: atf, lambda: btf)
 
-    # The chosen sequence is: AB
-    Pn_ = atf*Pn*(1-Pn) #A
-    Pnp_ = btf*(1-2*Pn_)
-    Pn_2 = btf*Pn_*(1-Pn_) #B
-    Pnp_2 = atf*(1-2*Pn_2)
+    # Warm-up: the sequence is iterated without accumulating the exponent
+    for i in tf.range(nb_transient*length):
+        Pn, _, rate = _sequence_step(atf, btf, is_a, i, Pn, rate)
 
-    # Computing Lyapunov exponent
-    n_ = n+2
-    E_ = 1/n_*(E*n+tf.log(tf.abs(Pnp_))+tf.log(tf.abs(Pnp_2)))
+    # Computing Lyapunov exponent: sum of the logs, averaged at the end
+    nb_steps = nb_iters*length
+    E = tf.zeros_like(Pn)
+    for start in tf.range(0, nb_steps, block_size*length):
+        prod = tf.ones_like(Pn)
+        scale = tf.zeros_like(Pn)
+        for i in tf.range(start, tf.minimum(start + block_size*length, nb_steps)):
+            Pn, dPn, rate = _sequence_step(atf, btf, is_a, i, Pn, rate)
+            prod, scale = _renormalise(prod*dPn, scale)
+        E += tf.math.log(tf.abs(prod)) + scale*LOG2
 
-    step = tf.group(n.assign(n_),
-                    E.assign(E_),
-                    Pn.assign(Pn_2))
+    return E/tf.cast(nb_steps, tf.float32)
+
+##Lyapunov fractal
+def lyapunov_exponent(P0, a, b, nb_iters, nb_transient=0, block_size=8,
+                      sequence="AB"):
+    """Compute the Lyapunov exponent of a sequence on the grid (a, b).
 
-    for i in range(nb_iters):
-        step.run()
+    sequence is a string of 'A' and 'B' giving the order in which the rates
+    a and b are applied (the AB sequence by default). nb_transient
+    repetitions of the sequence are first iterated and discarded so that the
+    population reaches its attractor. The derivatives of the following
+    nb_iters repetitions are then multiplied together by blocks of
+    block_size repetitions, taking one log per block.
 
-    Efinal = E.eval()
+    The iteration runs as one compiled loop without any session, so the
+    function can be called repeatedly and from several threads.
+    """
+    if not sequence or set(sequence) - set("AB"):
+        raise ValueError("sequence must be a non-empty string of 'A' and 'B'")
+    if nb_iters < 1 or block_size < 1:
+        raise ValueError("nb_iters and block_size must be at least 1")
 
-    sess.close()
+    Efinal = _lyapunov_loop(tf.convert_to_tensor(a, tf.float32),
+                            tf.convert_to_tensor(b, tf.float32),
+                            tf.constant([c == "A" for c in sequence]),
+                            tf.constant(P0, tf.float32),
+                            tf.constant(nb_iters, tf.int32),
+                            tf.constant(nb_transient, tf.int32),
+                            tf.constant(block_size, tf.int32))
 
-    return Efinal
+    return Efinal.numpy()
@@ -22,8 +22,9 @@ if __name__ == "__main__":
     P0 = 0.5
     a, b = np.mgrid[2:4:0.002, 2:4:0.002]
     nb_iters = 500
+    nb_transient = 100
     
-    Efinal = lyapunov.lyapunov_exponent(P0, a, b, nb_iters)
+    Efinal = lyapunov.lyapunov_exponent(P0, a, b, nb_iters, nb_transient)
     #print(Efinal.min(), Efinal.max())
 
     # Plot parameters
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+from os.path import abspath, dirname
+from sys import path
+import numpy as np
+
+path.append(dirname(dirname(abspath(__file__))))
+
+import lyapunov
+
+def test_contracting_large_block():
+    # For r = 2.5 the population settles on 0.6, where the derivative is -0.5:
+    # a block of 2000 steps multiplies to 2^-2000, far below float32.
+    a = np.full((2, 2), 2.5)
+    E = lyapunov.lyapunov_exponent(0.3, a, a, 20, nb_transient=50,
+                                   block_size=1000)
+    np.testing.assert_allclose(E, np.log(0.5), rtol=1e-3)
+    E1 = lyapunov.lyapunov_exponent(0.3, a, a, 20, nb_transient=50,
+                                    block_size=1)
+    np.testing.assert_allclose(E, E1, rtol=1e-4)
+
+def test_chaotic_large_block():
+    # For r = 4 the exponent is log 2: the product of a block overflows.
+    a = np.full((2, 2), 4.)
+    E = lyapunov.lyapunov_exponent(0.3, a, a, 20, nb_transient=50,
+                                   block_size=1000)
+    assert np.all(np.isfinite(E))
+    E1 = lyapunov.lyapunov_exponent(0.3, a, a, 20, nb_transient=50,
+                                    block_size=1)
+    np.testing.assert_allclose(E, E1, rtol=1e-4)
+
+def test_renormalise():
+    prod = np.array([1e-30, 3e30, -5., 0.], np.float32)
+    mantissa, scale = lyapunov._renormalise(prod, np.zeros(4, np.float32))
+    np.testing.assert_array_equal(scale, [-100, 101, 2, 0])
+    np.testing.assert_array_equal(mantissa*2.**scale.numpy(), prod)
+    assert np.all((np.abs(mantissa[:3]) >= 1) & (np.abs(mantissa[:3]) < 2))
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""Quadtree tile pyramid and tile cache for interactive Lyapunov exploration.
+
+The (a, b) parameter space is split into a quadtree: the tile of level l and
+index (ia, ib) covers 1/2^l of the root extent along each axis. Tiles always
+have the same number of pixels, so a coarse preview of any view is given by
+a few tiles of a low level, then refined by the levels below.
+
+Computed tiles are kept in a TileCache (LRU in memory, spilled to disk on
+eviction) keyed by their region, sequence, iterations and P0, so panning and
+zooming reuse every tile already computed.
+"""
+import collections
+import hashlib
+import math
+import os
+import threading
+
+import numpy as np
+
+import lyapunov
+
+class TileCache:
+    """LRU cache of tiles with optional on-disk spill.
+
+    Up to max_tiles tiles are kept in memory. When spill_dir is given, the
+    least recently used tiles are saved there as .npy files instead of being
+    dropped, and are loaded back on the next access.
+    """
+    def __init__(self, max_tiles=256, spill_dir=None):
+        self.max_tiles = max_tiles
+        self.spill_dir = spill_dir
+        self._tiles = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def _spill_path(self, key):
+        name = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.spill_dir, name + ".npy")
+
+    def get(self, key):
+        """Return the tile stored under key, or None."""
+        with self._lock:
+            if key in self._tiles:
+                self._tiles.move_to_end(key)
+                return self._tiles[key]
+        if self.spill_dir is not None:
+            path = self._spill_path(key)
+            if os.path.exists(path):
+                tile = np.load(path)
+                self.put(key, tile)
+                return tile
+        return None
+
+    def put(self, key, tile):
+        """Store tile under key, evicting the least recently used tiles."""
+        with self._lock:
+            self._tiles[key] = tile
+            self._tiles.move_to_end(key)
+            evicted = []
+            while len(self._tiles) > self.max_tiles:
+                evicted.append(self._tiles.popitem(last=False))
+        if self.spill_dir is not None:
+            for old_key, old_tile in evicted:
+                path = self._spill_path(old_key)
+                if not os.path.exists(path):
+                    np.save(path, old_tile)
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._tiles:
+                return True
+        return (self.spill_dir is not None
+                and os.path.exists(self._spill_path(key)))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._tiles)
+
+class LyapunovTilePyramid:
+    """Quadtree of Lyapunov tiles over the root extent (a0, a1, b0, b1).
+
+    Each tile is a (tile_size, tile_size) array of exponents sampled at the
+    pixel centres, with a along the first axis and b along the second one.
+    """
+    def __init__(self, extent=(2., 4., 2., 4.), sequence="AB", nb_iters=500,
+                 nb_transient=0, P0=0.5, tile_size=128, cache=None):
+        self.extent = tuple(float(e) for e in extent)
+        self.sequence = sequence
+        self.nb_iters = nb_iters
+        self.nb_transient = nb_transient
+        self.P0 = P0
+        self.tile_size = tile_size
+        self.cache = TileCache() if cache is None else cache
+
+    def tile_extent(self, level, ia, ib):
+        """Return the extent (a0, a1, b0, b1) covered by a tile."""
+        a0, a1, b0, b1 = self.extent
+        da = (a1 - a0) / 2**level
+        db = (b1 - b0) / 2**level
+        return (a0 + ia*da, a0 + (ia+1)*da, b0 + ib*db, b0 + (ib+1)*db)
+
+    def key(self, level, ia, ib):
+        """Cache key of a tile: its region and every parameter of the map."""
+        return (self.tile_extent(level, ia, ib), self.tile_size, self.sequence,
+                self.nb_iters, self.nb_transient, self.P0)
+
+    def tile(self, level, ia, ib):
+        """Return a tile, computing it only if it is not cached yet."""
+        key = self.key(level, ia, ib)
+        tile = self.cache.get(key)
+        if tile is None:
+            a0, a1, b0, b1 = self.tile_extent(level, ia, ib)
+            n = self.tile_size
+            a = a0 + (np.arange(n) + 0.5)*(a1 - a0)/n
+            b = b0 + (np.arange(n) + 0.5)*(b1 - b0)/n
+            a, b = np.meshgrid(a, b, indexing="ij")
+            tile = lyapunov.lyapunov_exponent(self.P0, a, b, self.nb_iters,
+                                              self.nb_transient,
+                                              sequence=self.sequence)
+            self.cache.put(key, tile)
+        return tile
+
+    def tile_range(self, view, level):
+        """Return the ranges of tile indices along a and b covering view."""
+        a0, a1, b0, b1 = self.extent
+        n = 2**level
+        va0, va1, vb0, vb1 = view
+        ia0 = min(max(int(math.floor((va0 - a0) / (a1 - a0) * n)), 0), n - 1)
+        ia1 = min(max(int(math.ceil((va1 - a0) / (a1 - a0) * n)), ia0 + 1), n)
+        ib0 = min(max(int(math.floor((vb0 - b0) / (b1 - b0) * n)), 0), n - 1)
+        ib1 = min(max(int(math.ceil((vb1 - b0) / (b1 - b0) * n)), ib0 + 1), n)
+        return range(ia0, ia1), range(ib0, ib1)
+
+    def level_for(self, view, resolution):
+        """Return the coarsest level giving at least resolution pixels
+        across the view along both axes."""
+        a0, a1, b0, b1 = self.extent
+        va0, va1, vb0, vb1 = view
+        fraction = min((va1 - va0) / (a1 - a0), (vb1 - vb0) / (b1 - b0))
+        tiles = resolution / (self.tile_size * fraction)
+        return max(int(math.ceil(math.log2(max(tiles, 1.)))), 0)
+
+    def render(self, view, level):
+        """Assemble the tiles of a level covering view.
+
+        Returns the image and the extent it actually covers (tile-aligned,
+        thus slightly larger than view).
+        """
+        ias, ibs = self.tile_range(view, level)
+        image = np.block([[self.tile(level, ia, ib) for ib in ibs]
+                          for ia in ias])
+        extent = (self.tile_extent(level, ias[0], ibs[0])[0],
+                  self.tile_extent(level, ias[-1], ibs[-1])[1],
+                  self.tile_extent(level, ias[0], ibs[0])[2],
+                  self.tile_extent(level, ias[-1], ibs[-1])[3])
+        return image, extent
+
+    def refine(self, view, resolution, start_level=0):
+        """Progressive rendering of view, coarsest level first.
+
+        Yields (level, image, extent) from start_level (or the finest level
+        of the view covered by a single tile, if finer) up to the level
+        giving resolution pixels across the view.
+        """
+        final_level = self.level_for(view, resolution)
+        first_level = min(max(start_level, self.level_for(view, self.tile_size)),
+                          final_level)
+        for level in range(first_level, final_level + 1):
+            image, extent = self.render(view, level)
+            yield level, image, extent